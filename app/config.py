@@ -16,4 +16,82 @@ def get_dify_api_keys():
         'bot3': os.getenv('DIFY_API_KEY_3', default_key)   # なければdefault_keyを使用
     }
 
-DIFY_API_KEYS = get_dify_api_keys() 
\ No newline at end of file
+DIFY_API_KEYS = get_dify_api_keys()
+
+# Dify APIのベースURL（負荷試験ではローカルのダミーサーバーを指定する）
+DIFY_BASE_URL = os.getenv('DIFY_BASE_URL', 'https://api.dify.ai/v1').rstrip('/')
+
+# 上流APIごとのHTTP接続プール設定
+# 例: HTTP_POOL_MAX_CONNECTIONS=100, HTTP_POOL_MAX_CONNECTIONS_DIFY_BOT2=20
+HTTP_POOL_DEFAULTS = {
+    'MAX_CONNECTIONS': 100,
+    'MAX_KEEPALIVE_CONNECTIONS': 20,
+    'KEEPALIVE_EXPIRY': 30.0,
+}
+
+def get_http_pool_settings(name: str) -> dict:
+    """接続プール名（例: "dify:bot2"）に対応する設定を環境変数から取得"""
+    suffix = ''.join(c if c.isalnum() else '_' for c in name).upper()
+    settings = {}
+    for key, default in HTTP_POOL_DEFAULTS.items():
+        value = os.getenv(f'HTTP_POOL_{key}_{suffix}', os.getenv(f'HTTP_POOL_{key}'))
+        settings[key.lower()] = type(default)(value) if value is not None else default
+    return settings
+
+# 会話IDなし（初回）の質問に対するDify応答キャッシュの設定
+DIFY_CACHE_TTL = float(os.getenv('DIFY_CACHE_TTL', '600'))  # 秒
+DIFY_CACHE_MAX_ENTRIES = int(os.getenv('DIFY_CACHE_MAX_ENTRIES', '1000'))
+# キャッシュしないボット（カンマ区切り、例: "bot3"）
+DIFY_CACHE_DISABLED_BOTS = {
+    mode.strip() for mode in os.getenv('DIFY_CACHE_DISABLED_BOTS', '').split(',') if mode.strip()
+}
+
+# ボットモードごとのDify同時実行数の上限と待ち行列
+# 例: DIFY_MAX_CONCURRENCY=10, DIFY_MAX_CONCURRENCY_BOT2=4
+DIFY_LIMIT_DEFAULTS = {
+    'MAX_CONCURRENCY': 10,
+    'MAX_QUEUE': 50,
+    'QUEUE_TIMEOUT': 10.0,  # 秒
+}
+
+def get_dify_limit_settings(mode: str) -> dict:
+    """ボットモードに対応する同時実行数の設定を環境変数から取得"""
+    suffix = ''.join(c if c.isalnum() else '_' for c in mode).upper()
+    settings = {}
+    for key, default in DIFY_LIMIT_DEFAULTS.items():
+        value = os.getenv(f'DIFY_{key}_{suffix}', os.getenv(f'DIFY_{key}'))
+        settings[key.lower()] = type(default)(value) if value is not None else default
+    return settings
+
+# Dify APIの再試行（接続エラー・429・5xx）とサーキットブレーカーの設定
+DIFY_RETRY_ATTEMPTS = int(os.getenv('DIFY_RETRY_ATTEMPTS', '3'))  # 最初の1回を含む
+DIFY_RETRY_BASE_DELAY = float(os.getenv('DIFY_RETRY_BASE_DELAY', '0.2'))  # 秒
+DIFY_RETRY_MAX_DELAY = float(os.getenv('DIFY_RETRY_MAX_DELAY', '2.0'))  # 秒
+DIFY_BREAKER_FAILURE_THRESHOLD = int(os.getenv('DIFY_BREAKER_FAILURE_THRESHOLD', '5'))  # 連続失敗回数
+DIFY_BREAKER_RECOVERY_TIMEOUT = float(os.getenv('DIFY_BREAKER_RECOVERY_TIMEOUT', '30'))  # 秒
+
+# WebSocketの1接続あたりで同時に処理するメッセージ数の上限
+WS_MAX_CONCURRENCY = int(os.getenv('WS_MAX_CONCURRENCY', '4'))
+
+# WebSocket接続の管理
+WS_HEARTBEAT_INTERVAL = float(os.getenv('WS_HEARTBEAT_INTERVAL', '20'))  # 秒。受信がなければpingを送る間隔
+WS_PONG_TIMEOUT = float(os.getenv('WS_PONG_TIMEOUT', '20'))  # 秒。pingの後この時間内に受信がなければ切断
+WS_IDLE_TIMEOUT = float(os.getenv('WS_IDLE_TIMEOUT', '900'))  # 秒。メッセージの送信がない接続を切断
+WS_SEND_QUEUE_SIZE = int(os.getenv('WS_SEND_QUEUE_SIZE', '256'))  # 接続ごとの送信待ちフレーム数の上限
+
+# WebSocketの配信方式（local: このプロセスの接続のみ / sqlite: 共有のSQLiteテーブル経由で全ワーカーに配信）
+WS_ROUTING_BACKEND = os.getenv('WS_ROUTING_BACKEND', 'local')
+WS_OUTBOX_POLL_INTERVAL = float(os.getenv('WS_OUTBOX_POLL_MS', '50')) / 1000  # 秒
+WS_OUTBOX_RETENTION = float(os.getenv('WS_OUTBOX_RETENTION', '60'))  # 秒
+
+# WebSocketで応答を送る際に細かい断片をまとめる条件（どちらかを満たしたら送信）
+WS_STREAM_FLUSH_INTERVAL = float(os.getenv('WS_STREAM_FLUSH_MS', '50')) / 1000  # 秒
+WS_STREAM_FLUSH_CHARS = int(os.getenv('WS_STREAM_FLUSH_CHARS', '200'))
+WS_STREAM_BUFFER_EVENTS = int(os.getenv('WS_STREAM_BUFFER_EVENTS', '64'))  # 送信が追いつかない間に先読みするイベント数
+
+# GET /conversations/{id}/messages?since=...&wait=... で新着を待つ時間の上限（秒）
+MESSAGES_LONG_POLL_MAX_WAIT = float(os.getenv('MESSAGES_LONG_POLL_MAX_WAIT', '30'))
+
+# /chat で確保した応答分のトークンのうち、この時間（秒）を過ぎても精算されないものは返却する
+TOKEN_RESERVATION_TTL = float(os.getenv('TOKEN_RESERVATION_TTL', '600'))
+TOKEN_RESERVATION_SWEEP_INTERVAL = float(os.getenv('TOKEN_RESERVATION_SWEEP_INTERVAL', '60'))  # 秒
@@ -1,19 +1,50 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Index, DDL, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from datetime import datetime
+from . import storage
+from .services.sql_monitor import instrument_engine
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
+SQLALCHEMY_DATABASE_URL = storage.SQLALCHEMY_DATABASE_URL
+ASYNC_DATABASE_URL = storage.ASYNC_DATABASE_URL  # 同期エンジンと同じDBファイル
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+engine = storage.create_sync_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# リクエストハンドラー用の非同期エンジンとセッション
+async_engine = storage.create_async_write_engine()
+AsyncSessionLocal = async_sessionmaker(
+    async_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False
+)
+
+# 読み取り専用のエンジンとセッション（書き込みを待たない）
+async_read_engine = storage.create_async_read_engine()
+AsyncReadSessionLocal = async_sessionmaker(
+    async_read_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False
+)
+
+# リクエストごとのクエリ数・DB時間・コミット数を集計
+for _engine in (engine, async_engine.sync_engine, async_read_engine.sync_engine):
+    instrument_engine(_engine)
+
 Base = declarative_base()
 
 class Conversation(Base):
     __tablename__ = "conversations"
+    __table_args__ = (
+        # 会話一覧（user_idで絞り込み、is_pinned desc, created_at descで並べ替え）
+        # SQLiteのインデックスは末尾に暗黙的にidを含むため、(created_at, id) の順序も満たす
+        Index("ix_conversations_user_pinned_created", "user_id", "is_pinned", "created_at"),
+        # ユーザーの最新の会話（/chat）
+        Index("ix_conversations_user_created", "user_id", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(String)
@@ -27,6 +58,12 @@ class Conversation(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # 会話ごとのメッセージ履歴（conversation_idで絞り込み、created_atで並べ替え）と一括削除
+        Index("ix_messages_conversation_created", "conversation_id", "created_at"),
+        # 会話の新着メッセージ（conversation_idで絞り込み、指定したidより後ろ）
+        Index("ix_messages_conversation_id", "conversation_id", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     conversation_id = Column(Integer)
@@ -34,6 +71,37 @@ class Message(Base):
     role = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+# メッセージの全文検索（FTS5）。messagesを外部コンテンツとし、トリガーで同期する
+# trigramトークナイザーは分かち書きのない日本語でも部分一致で検索できる（3文字以上）
+MESSAGE_SEARCH_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, content='messages', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+]
+
+# create_allでmessagesを作成したときに検索用のテーブルとトリガーも作成する
+# （既存のデータベースには app/migrations/add_message_search.py を実行する）
+for _statement in MESSAGE_SEARCH_DDL:
+    event.listen(Message.__table__, "after_create", DDL(_statement))
+
 class TokenUsage(Base):
     __tablename__ = "token_usage"
 
@@ -42,10 +110,52 @@ class TokenUsage(Base):
     remaining_tokens = Column(Integer, default=200)
     last_updated = Column(DateTime, default=datetime.utcnow)
 
+class TokenReservation(Base):
+    """/chat で確保し、/chat/response で精算する応答分のトークン"""
+    __tablename__ = "token_reservations"
+    __table_args__ = (
+        # 期限切れの予約の返却（created_atで絞り込み）
+        Index("ix_token_reservations_created", "created_at"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String)
+    amount = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class OutboxMessage(Base):
+    """WebSocketの送信待ちメッセージ（複数のワーカー間で配信する。一定時間後に削除）"""
+    __tablename__ = "ws_outbox"
+    __table_args__ = (
+        Index("ix_ws_outbox_created", "created_at"),
+        # 削除後もIDを再利用しない（各ワーカーは読んだ最後のIDより大きい行を配信する）
+        {"sqlite_autoincrement": True},
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(String)
+    payload = Column(String)  # JSON
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class SyncVersion(Base):
+    """書き込みのたびに増やすバージョン（scopeは "user:<user_id>" / "conversation:<id>"）。ETagに使う"""
+    __tablename__ = "sync_versions"
+
+    scope = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
 # データベース接続のための依存関数
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close() 
\ No newline at end of file
+        db.close() 
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def get_async_read_db():
+    async with AsyncReadSessionLocal() as db:
+        yield db
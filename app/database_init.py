@@ -1,13 +1,12 @@
-from sqlalchemy import create_engine
-from app.database import Base
+from app import storage
 import os
 
-# データベースファイルが存在する場合は削除
-if os.path.exists("test.db"):
-    os.remove("test.db")
+# データベースファイル（WALファイルを含む）が存在する場合は削除
+for suffix in ("", "-wal", "-shm"):
+    if os.path.exists(storage.DATABASE_PATH + suffix):
+        os.remove(storage.DATABASE_PATH + suffix)
 
-# エンジンを作成
-engine = create_engine('sqlite:///./test.db')
+from app.database import Base, engine  # 削除後にエンジンを作成
 
 # テーブルを作成
 Base.metadata.create_all(bind=engine)
@@ -1,32 +1,70 @@
-from fastapi import FastAPI, Depends, HTTPException, Body, Request, WebSocket, status
-from sqlalchemy.orm import Session
-from . import database
-from .database import Base, engine, SessionLocal  # ここでBaseとengineをインポート
-from datetime import datetime
+from fastapi import FastAPI, Depends, HTTPException, Body, Query, Request, Response, WebSocket, status
+from . import database, repository
+from .database import Base, engine, get_async_db, get_async_read_db  # ここでBaseとengineをインポート
+from .config import MESSAGES_LONG_POLL_MAX_WAIT
+from .pagination import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    decode_conversation_cursor,
+    decode_message_cursor,
+    decode_search_cursor,
+    encode_cursor,
+)
 from pydantic import BaseModel
-from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
-import json
-import tiktoken
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import PlainTextResponse
 from fastapi.responses import JSONResponse
-import httpx
+import asyncio
 import os
+from contextlib import asynccontextmanager
 from fastapi.exceptions import RequestValidationError
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.ext.asyncio import create_async_engine
 import logging
-from typing import Optional
+from typing import List, Optional
 import traceback  # スタックトレース用
 from .routers import support  # この行を追加
+from .routers import chat as chat_router
+from .routers import profiling
 from .services.dify.client import DifyClient
+from .services.dify.streaming import stream_frames
+from .services.connections import connections, new_request_id
+from .services.routing import routing_backend
+from .services.http_client import http_clients
+from .services import quota, versions
+from .services.writer import writer
+from .services.message_events import message_notifier
+from .services.tokenizer import token_counter
+from .services import metrics
+from .services.profiler import PROFILING_ENABLED, ProfilingMiddleware
+from .services.sql_monitor import QueryStatsMiddleware
+from .services.assets import static_assets
 
 load_dotenv()
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # エンコーダーを事前に読み込む（読み込めない場合は起動に失敗させる）
+    token_counter.load()
+    # 静的ファイルをメモリに読み込み、圧縮とハッシュ付きの名前を用意する
+    static_assets.load()
+    writer.start()
+    quota.reservation_sweeper.start()
+    await routing_backend.start()
+    yield
+    # WebSocket接続を閉じ、キューに残っている書き込みをコミット
+    await routing_backend.stop()
+    await connections.stop()
+    await quota.reservation_sweeper.stop()
+    await writer.stop()
+    await database.async_engine.dispose()
+    await database.async_read_engine.dispose()
+    token_counter.close()
+    # 共有HTTP接続プールを閉じる
+    await http_clients.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORSの設定
 app.add_middleware(
@@ -37,30 +75,30 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 静的ファイルの提供
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# リクエスト数・処理時間などのメトリクス（/metrics）
+app.add_middleware(QueryStatsMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 
-# 同期的なデータベースの初期化
-Base.metadata.create_all(bind=engine) # 既存のengineを使用
+# リクエスト単位のプロファイリング（有効時のみ。無効時はミドルウェア自体を登録しない）
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
 
-# データベースの設定
-DATABASE_URL = "sqlite+aiosqlite:///./test.db"  # 既存のDBと同じパスを使用
+# 静的ファイルの提供（起動時に読み込んだものをメモリから返す）
+app.mount("/static", static_assets, name="static")
 
-# 非同期ンジンとセッションの作成
-async_engine = create_async_engine(DATABASE_URL)
-async_session = sessionmaker(
-    async_engine,
-    class_=AsyncSession,
-    expire_on_commit=False
-)
+# 同期的なデータベースの初期化
+Base.metadata.create_all(bind=engine) # 既存のengineを使用
 
 # ルーターの追加
 app.include_router(support.router)
+app.include_router(chat_router.router)  # /ws/{user_id}
+if PROFILING_ENABLED:
+    app.include_router(profiling.router)  # /admin/profiles
 
-# ルートパスでindex.htmlを提供
+# ルートパスでindex.htmlを提供（/static/... への参照はハッシュ付きの名前に書き換え済み）
 @app.get("/")
-async def read_root():
-    return FileResponse('static/index.html')
+async def read_root(request: Request):
+    return static_assets.index(request)
 
 class MessageRequest(BaseModel):
     user_id: str
@@ -73,42 +111,27 @@ class MessageSave(BaseModel):
     conversation_id: int
     user_id: str
 
-def get_db():
-    db = database.SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-def count_tokens(text: str) -> int:
-    try:
-        encoding = tiktoken.get_encoding("cl100k_base")
-        return len(encoding.encode(text))
-    except Exception as e:
-        logger.error(f"Error counting tokens: {str(e)}")
-        return len(text) // 4  # フォールバック：簡易的な推定
-
 # ログ設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 @app.get("/tokens/{user_id}")
-def get_remaining_tokens(user_id: str, db: Session = Depends(get_db)):
+async def get_remaining_tokens(
+    user_id: str,
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_async_db)
+):
+    # 前回から変更がなければ304（トークン使用量は読まない）
+    tag = versions.etag(request, await versions.current(db, versions.user_scope(user_id)))
+    if versions.is_fresh(request, tag):
+        return versions.not_modified(tag)
+    response.headers.update(versions.cache_headers(tag))
     try:
-        token_usage = db.query(database.TokenUsage).filter(
-            database.TokenUsage.user_id == user_id
-        ).first()
+        token_usage = await repository.get_or_create_token_usage(db, user_id)
         
         logger.info(f"Token check for user {user_id}: {token_usage}")
         
-        if not token_usage:
-            # 新規ユーザーの場合は初期トークンを設定
-            token_usage = database.TokenUsage(user_id=user_id)
-            db.add(token_usage)
-            db.commit()
-            db.refresh(token_usage)
-            logger.info(f"Created new token usage for user {user_id}")
-        
         return {"remaining_tokens": token_usage.remaining_tokens}
         
     except Exception as e:
@@ -116,43 +139,193 @@ def get_remaining_tokens(user_id: str, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/conversations/{user_id}")
-def get_conversations(user_id: str, db: Session = Depends(get_db)):
+async def get_conversations(
+    user_id: str,
+    request: Request,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """会話一覧をページ単位で取得（next_cursorをafterに渡すと次のページ）"""
+    after_key = decode_conversation_cursor(after)
+    before_key = decode_conversation_cursor(before)
+    # 前回から変更がなければ304（会話一覧は読まない）
+    tag = versions.etag(request, await versions.current(db, versions.user_scope(user_id)))
+    if versions.is_fresh(request, tag):
+        return versions.not_modified(tag)
+    response.headers.update(versions.cache_headers(tag))
     try:
-        conversations = db.query(database.Conversation).filter(
-            database.Conversation.user_id == user_id
-        ).order_by(
-            database.Conversation.is_pinned.desc(),  # ピン留めを優先
-            database.Conversation.created_at.desc()
-        ).all()
+        conversations = await repository.list_conversations(
+            db, user_id, limit=limit + 1, after=after_key, before=before_key
+        )
         
         logger.info(f"Found {len(conversations)} conversations for user {user_id}")
         
-        return [{
-            "id": conv.id,
-            "title": conv.title,
-            "created_at": conv.created_at,
-            "is_pinned": conv.is_pinned
-        } for conv in conversations]
+        # 1件多く読み、続きがあるかを判定する
+        has_more = len(conversations) > limit
+        if before_key is not None and after_key is None:
+            conversations = conversations[-limit:]
+        else:
+            conversations = conversations[:limit]
+        
+        next_cursor = None
+        if conversations and (has_more or before_key is not None):
+            last = conversations[-1]
+            next_cursor = encode_cursor(bool(last.is_pinned), last.created_at, last.id)
+        
+        return {
+            "items": [{
+                "id": conv.id,
+                "title": conv.title,
+                "created_at": conv.created_at,
+                "is_pinned": conv.is_pinned
+            } for conv in conversations],
+            "next_cursor": next_cursor
+        }
         
     except Exception as e:
         logger.error(f"Error in get_conversations: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/conversations/{conversation_id}/messages")
-def get_messages(conversation_id: int, db: Session = Depends(get_db)):
-    """特定の会話のメッセージを取得"""
-    messages = db.query(database.Message).filter(
-        database.Message.conversation_id == conversation_id
-    ).order_by(database.Message.created_at).all()
+async def get_messages(
+    conversation_id: int,
+    request: Request,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    since: Optional[int] = Query(None, ge=0),
+    wait: float = Query(0, ge=0, le=MESSAGES_LONG_POLL_MAX_WAIT),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """特定の会話のメッセージを取得
+
+    指定なしの場合は最新のlimit件を返し、next_cursorをbeforeに渡すとさらに古いページ、
+    afterを指定した場合はそれより新しいメッセージを返す（next_cursorをafterに渡して続きを取得）。
+
+    sinceにメッセージIDを指定すると、それより新しいメッセージだけをID順に返す（last_idを次の
+    sinceに渡す）。waitも指定すると、新着がなければ保存されるまで最大wait秒待ってから返す。
+    """
+    if since is not None:
+        return await _get_messages_since(conversation_id, since, limit, wait, request, response, db)
+    
+    after_key = decode_message_cursor(after)
+    before_key = decode_message_cursor(before)
+    # 前回から変更がなければ304（メッセージは読まない）
+    tag = versions.etag(request, await versions.current(db, versions.conversation_scope(conversation_id)))
+    if versions.is_fresh(request, tag):
+        return versions.not_modified(tag)
+    response.headers.update(versions.cache_headers(tag))
+    messages = await repository.list_messages(
+        db, conversation_id, limit=limit + 1, after=after_key, before=before_key
+    )
     
-    return [{
+    # 1件多く読み、続きがあるかを判定する
+    has_more = len(messages) > limit
+    if after_key is not None:
+        messages = messages[:limit]
+        edge = messages[-1] if messages else None
+    else:
+        messages = messages[-limit:]
+        edge = messages[0] if messages else None
+    
+    next_cursor = None
+    if edge is not None and (has_more or after_key is not None):
+        next_cursor = encode_cursor(edge.created_at, edge.id)
+    
+    return {
+        "items": [_message_item(msg) for msg in messages],
+        "next_cursor": next_cursor
+    }
+
+async def _get_messages_since(
+    conversation_id: int,
+    since: int,
+    limit: int,
+    wait: float,
+    request: Request,
+    response: Response,
+    db: AsyncSession
+):
+    """会話のsinceより新しいメッセージ（読むのは新着の行だけ）"""
+    waiter = None
+    if wait:
+        # 新着の確認より前に登録し、確認と待機の間に保存されたメッセージを取りこぼさない
+        waiter = message_notifier.subscribe(conversation_id)
+    else:
+        tag = versions.etag(request, await versions.current(db, versions.conversation_scope(conversation_id)))
+        if versions.is_fresh(request, tag):
+            return versions.not_modified(tag)
+        response.headers.update(versions.cache_headers(tag))
+    
+    try:
+        messages = await repository.list_messages_since(db, conversation_id, since, limit=limit + 1)
+        if not messages and waiter is not None:
+            await db.close()  # 待つ間、接続をプールに返す
+            await message_notifier.wait(conversation_id, waiter, wait)
+            waiter = None
+            messages = await repository.list_messages_since(db, conversation_id, since, limit=limit + 1)
+    finally:
+        if waiter is not None:
+            message_notifier.unsubscribe(conversation_id, waiter)
+    
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    return {
+        "items": [_message_item(msg) for msg in messages],
+        "last_id": messages[-1].id if messages else since,
+        "has_more": has_more
+    }
+
+def _message_item(msg: database.Message) -> dict:
+    return {
+        "id": msg.id,
         "content": msg.content,
         "role": msg.role,
         "created_at": msg.created_at
-    } for msg in messages]
+    }
+
+@app.get("/search")
+async def search_messages(
+    user_id: str,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """利用者のメッセージを全文検索（関連度順）
+
+    snippetは一致箇所の周辺をHTMLエスケープし、一致箇所を<mark>で囲んだもの。
+    next_cursorをcursorに渡すと次のページを取得する。
+    """
+    rows = await repository.search_messages(
+        db, user_id, q, limit=limit + 1, after=decode_search_cursor(cursor)
+    )
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = None
+    if has_more:
+        next_cursor = encode_cursor(rows[-1]["rank"], rows[-1]["id"])
+    
+    return {
+        "items": [{
+            "id": row["id"],
+            "conversation_id": row["conversation_id"],
+            "conversation_title": row["title"],
+            "role": row["role"],
+            "created_at": row["created_at"],
+            "snippet": row["snippet"],
+            "rank": row["rank"]
+        } for row in rows],
+        "next_cursor": next_cursor
+    }
 
 @app.post("/chat")
-async def chat(request: Request, db: Session = Depends(get_db)):
+async def chat(request: Request, db: AsyncSession = Depends(get_async_read_db)):
     try:
         data = await request.json()
         message_request = MessageRequest(
@@ -164,62 +337,70 @@ async def chat(request: Request, db: Session = Depends(get_db)):
         logger.info(f"Processing chat request for user {message_request.user_id}")
         
         # 入力のトークン数を計算
-        input_tokens = count_tokens(message_request.message)
+        input_tokens = await token_counter.count_async(message_request.message)
         estimated_response_tokens = input_tokens * 2  # 初期見積もり
         required_tokens = input_tokens + estimated_response_tokens
         
-        # トークン使用量をチェック
-        usage = db.query(database.TokenUsage).filter(
-            database.TokenUsage.user_id == message_request.user_id
-        ).first()
+        # 最新の会話を取得（なければ書き込み時に作成）
+        latest = await repository.get_latest_conversation(db, message_request.user_id)
+        await db.close()  # 書き込み完了を待つ間、接続をプールに返す
         
-        if not usage:
-            usage = database.TokenUsage(user_id=message_request.user_id, remaining_tokens=200)
-            db.add(usage)
-            db.commit()
-            db.refresh(usage)
+        async def write(session: AsyncSession):
+            # 必要なトークン数を確保（残量の確認と減算を1文で行う）
+            # 応答分の見積もりは /chat/response で実際のトークン数と精算する
+            reservation = await quota.reserve(
+                session,
+                message_request.user_id,
+                required_tokens,
+                hold=estimated_response_tokens
+            )
+            if reservation is None:
+                return None
+            
+            conversation_id = latest.id if latest else None
+            if conversation_id is None:
+                conversation = await repository.create_conversation(
+                    session,
+                    user_id=message_request.user_id,
+                    title=message_request.message[:30] + "...",
+                    commit=False
+                )
+                conversation_id = conversation.id
+            
+            # メッセージを保存（トークンの確保と同じトランザクションでコミット）
+            await repository.add_message(
+                session,
+                conversation_id=conversation_id,
+                content=message_request.message,
+                role="user",
+                commit=False
+            )
+            await versions.bump(session, user_id=message_request.user_id, conversation_id=conversation_id)
+            return reservation + (conversation_id,)
         
-        # 必要なトークン数をチェック
-        if usage.remaining_tokens < required_tokens:
+        # 他のリクエストの書き込みとまとめてコミット
+        result = await writer.submit(write)
+        
+        if result is None:
             logger.warning(f"Insufficient tokens for user {message_request.user_id}")
+            metrics.quota_rejections_total.inc()
+            metrics.tokens_rejected_total.inc(required_tokens)
             return JSONResponse(
                 status_code=403,
                 content={"detail": "Insufficient tokens. Please reset your tokens."}
             )
+        remaining_tokens, reservation_id, conversation_id = result
+        message_notifier.notify(conversation_id)
+        metrics.tokens_consumed_total.inc(input_tokens, kind="input")
         
-        # トークンを消費
-        usage.remaining_tokens -= input_tokens
-        db.commit()
-        
-        # 会話を取得または作成
-        conversation = db.query(database.Conversation).filter(
-            database.Conversation.user_id == message_request.user_id
-        ).order_by(database.Conversation.created_at.desc()).first()
-        
-        if not conversation:
-            conversation = database.Conversation(
-                user_id=message_request.user_id,
-                title=message_request.message[:30] + "..."
-            )
-            db.add(conversation)
-            db.commit()
-        
-        # メッセージを保存
-        message = database.Message(
-            conversation_id=conversation.id,
-            content=message_request.message,
-            role="user"
-        )
-        db.add(message)
-        db.commit()
-        
-        logger.info(f"Successfully processed message for conversation {conversation.id}")
+        logger.info(f"Successfully processed message for conversation {conversation_id}")
         
         return {
             "status": "success",
-            "remaining_tokens": usage.remaining_tokens,
+            "remaining_tokens": remaining_tokens,
             "input_tokens": input_tokens,
-            "conversation_id": conversation.id
+            "conversation_id": conversation_id,
+            "reservation_id": reservation_id
         }
         
     except Exception as e:
@@ -235,7 +416,7 @@ async def chat(request: Request, db: Session = Depends(get_db)):
 @app.post("/chat/response")
 async def record_response(
     response: dict,  # JSONとして受け取るように変更
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     response_text = response.get('response')
     user_id = response.get('user_id')
@@ -243,40 +424,58 @@ async def record_response(
     if not response_text or not user_id:
         raise HTTPException(status_code=400, detail="Missing response text or user_id")
     
-    response_tokens = count_tokens(response_text)
+    response_tokens = await token_counter.count_async(response_text)
     
-    usage = db.query(database.TokenUsage).filter(
-        database.TokenUsage.user_id == user_id
-    ).first()
+    await versions.bump(db, user_id=user_id)  # settleと同じトランザクションでコミット
+    # /chat で確保した見積もり分と実際の応答トークン数を精算
+    remaining_tokens = await quota.settle(
+        db,
+        user_id,
+        response_tokens,
+        reservation_id=response.get('reservation_id')
+    )
     
-    if usage:
-        usage.remaining_tokens -= response_tokens
-        db.commit()
+    if remaining_tokens is None:
+        raise HTTPException(status_code=404, detail="Token usage not found")
+    metrics.tokens_consumed_total.inc(response_tokens, kind="response")
     
     return {
         "status": "success",
-        "remaining_tokens": usage.remaining_tokens,
+        "remaining_tokens": remaining_tokens,
         "response_tokens": response_tokens
     }
 
-@app.post("/tokens/reset/{user_id}")
-def reset_tokens(user_id: str, db: Session = Depends(get_db)):
-    usage = db.query(database.TokenUsage).filter(
-        database.TokenUsage.user_id == user_id
-    ).first()
+@app.post("/chat/release")
+async def release_reservation(request: dict, db: AsyncSession = Depends(get_async_db)):
+    """応答を取得できなかった場合に、/chat で確保した応答分のトークンを返却する"""
+    user_id = request.get('user_id')
+    reservation_id = request.get('reservation_id')
+    if not user_id or reservation_id is None:
+        raise HTTPException(status_code=400, detail="Missing user_id or reservation_id")
     
-    if usage:
-        usage.remaining_tokens = 200
-        usage.last_updated = datetime.utcnow()
-    else:
-        usage = database.TokenUsage(user_id=user_id, remaining_tokens=200)
-        db.add(usage)
+    await versions.bump(db, user_id=user_id)  # settleと同じトランザクションでコミット
+    # 実際の消費量0で精算する（予約分をすべて返却）
+    remaining_tokens = await quota.settle(db, user_id, 0, reservation_id=reservation_id)
+    if remaining_tokens is None:
+        raise HTTPException(status_code=404, detail="Token usage not found")
     
-    db.commit()
-    db.refresh(usage)
+    return {"status": "success", "remaining_tokens": remaining_tokens}
+
+@app.post("/tokens/reset/{user_id}")
+async def reset_tokens(user_id: str, db: AsyncSession = Depends(get_async_db)):
+    await versions.bump(db, user_id=user_id)
+    usage = await repository.reset_token_usage(db, user_id)
     
     return {"message": "Tokens reset successfully", "remaining_tokens": usage.remaining_tokens}
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheusのテキスト形式でメトリクスを返す"""
+    return PlainTextResponse(
+        metrics.registry.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
 @app.get("/api/config")
 async def get_config():
     return {
@@ -284,27 +483,69 @@ async def get_config():
     }
 
 @app.post("/messages")
-def save_message(request: MessageSave, db: Session = Depends(get_db)):
+async def save_message(request: MessageSave):
     """メッセージを保存"""
-    message = database.Message(
-        conversation_id=request.conversation_id,
-        content=request.content,
-        role=request.role
-    )
-    db.add(message)
-    db.commit()
+    async def write(session: AsyncSession):
+        session.add(database.Message(
+            conversation_id=request.conversation_id,
+            content=request.content,
+            role=request.role
+        ))
+        await versions.bump(session, conversation_id=request.conversation_id)
+    
+    await writer.submit(write)
+    message_notifier.notify(request.conversation_id)
     
     return {"status": "success"}
 
+@app.post("/messages/batch")
+async def save_messages(requests: List[MessageSave]):
+    """複数のメッセージを1回のコミットで保存"""
+    conversation_ids = {request.conversation_id for request in requests}
+    
+    async def write(session: AsyncSession):
+        # 失敗時に単独で再実行されることがあるため、オブジェクトは毎回ここで作る
+        messages = [
+            database.Message(
+                conversation_id=request.conversation_id,
+                content=request.content,
+                role=request.role
+            )
+            for request in requests
+        ]
+        session.add_all(messages)
+        for conversation_id in conversation_ids:
+            await versions.bump(session, conversation_id=conversation_id)
+        return messages
+    
+    # トークン数の計算（長いテキストはスレッドプール）と書き込みを並行して行う
+    messages, token_counts = await asyncio.gather(
+        writer.submit(write),
+        token_counter.count_batch([request.content for request in requests])
+    )
+    message_notifier.notify(*conversation_ids)
+    
+    return {
+        "status": "success",
+        "message_ids": [message.id for message in messages],
+        "token_counts": token_counts
+    }
+
 @app.post("/conversations/new")
-def create_new_conversation(request: dict, db: Session = Depends(get_db)):
+async def create_new_conversation(request: dict):
     """新しい会話を作成"""
-    conversation = database.Conversation(
-        user_id=request.get('user_id'),
-        title="新しいトーク"  # 初期タイトル
-    )
-    db.add(conversation)
-    db.commit()
+    async def write(session: AsyncSession):
+        # 失敗時に単独で再実行されることがあるため、オブジェクトは毎回ここで作る
+        conversation = database.Conversation(
+            user_id=request.get('user_id'),
+            title="新しいトーク"  # 初期タイトル
+        )
+        session.add(conversation)
+        await versions.bump(session, user_id=conversation.user_id)
+        return conversation
+    
+    conversation = await writer.submit(write)
+    await _publish_conversations_changed(conversation.user_id, conversation.id)
     
     return {
         "status": "success",
@@ -312,19 +553,17 @@ def create_new_conversation(request: dict, db: Session = Depends(get_db)):
     }
 
 @app.put("/conversations/{conversation_id}/title")
-def update_conversation_title(
+async def update_conversation_title(
     conversation_id: int, 
     title_data: dict, 
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     print(f"Updating title for conversation {conversation_id}")
     print(f"Title data: {title_data}")
     
     try:
         # 会話を取得
-        conversation = db.query(database.Conversation).filter(
-            database.Conversation.id == conversation_id
-        ).first()
+        conversation = await repository.get_conversation(db, conversation_id)
         
         if not conversation:
             print(f"Conversation {conversation_id} not found")
@@ -338,17 +577,21 @@ def update_conversation_title(
             conversation.title = new_title
             
             try:
-                db.commit()
+                await versions.bump(db, user_id=conversation.user_id)
+                await db.commit()
                 print("Title updated successfully")
+                await _publish_conversations_changed(conversation.user_id, conversation_id)
             except Exception as commit_error:
                 print(f"Commit error: {str(commit_error)}")
-                db.rollback()
+                await db.rollback()
                 raise
         else:
             print("Title update skipped - not a manual update")
             
         return {"status": "success", "title": conversation.title}
             
+    except HTTPException:
+        raise
     except SQLAlchemyError as e:
         print(f"Database error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
@@ -357,140 +600,133 @@ def update_conversation_title(
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
 @app.delete("/conversations/{conversation_id}")
-def delete_conversation(conversation_id: int, db: Session = Depends(get_db)):
+async def delete_conversation(conversation_id: int, db: AsyncSession = Depends(get_async_db)):
     try:
         # 会話を取得
-        conversation = db.query(database.Conversation).filter(
-            database.Conversation.id == conversation_id
-        ).first()
+        conversation = await repository.get_conversation(db, conversation_id)
         
         if not conversation:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
-        # 関連するメッセージも削除
-        db.query(database.Message).filter(
-            database.Message.conversation_id == conversation_id
-        ).delete()
-        
-        # 会話を削除
-        db.delete(conversation)
-        db.commit()
+        # 関連するメッセージも含めて削除
+        await versions.bump(db, user_id=conversation.user_id, conversation_id=conversation.id)
+        await repository.delete_conversation(db, conversation)
+        message_notifier.notify(conversation_id)  # 待っているリクエストに空の結果を返す
+        await _publish_conversations_changed(conversation.user_id, conversation_id)
         
         return {"status": "success"}
             
     except SQLAlchemyError as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
 @app.put("/conversations/{conversation_id}/pin")
-async def toggle_pin(conversation_id: int, db: Session = Depends(get_db)):
+async def toggle_pin(conversation_id: int, db: AsyncSession = Depends(get_async_db)):
     try:
-        conversation = db.query(database.Conversation).filter(
-            database.Conversation.id == conversation_id
-        ).first()
+        conversation = await repository.get_conversation(db, conversation_id)
         
         if not conversation:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
         # ピン留め状態を切り替え
         conversation.is_pinned = not conversation.is_pinned
-        db.commit()
+        await versions.bump(db, user_id=conversation.user_id)
+        await db.commit()
+        await _publish_conversations_changed(conversation.user_id, conversation_id)
         
         return {
             "status": "success",
             "is_pinned": conversation.is_pinned
         }
             
+    except HTTPException:
+        raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         print(f"Error in toggle_pin: {str(e)}")  # デバッグ用
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/")
-async def get():
-    with open("static/index.html") as f:
-        return HTMLResponse(f.read())
+ws_dify_client = DifyClient()
+
+async def _stream_reply(message: str):
+    """Dify APIをstreamingモードで呼び出し、`start`・まとめた断片の `delta`・全文と使用量の `end` を返す"""
+    try:
+        async for frame in stream_frames(ws_dify_client.stream_message(message)):
+            yield frame
+    except HTTPException as e:
+        yield {"type": "error", "content": f"エラーが発生しました: {e.status_code}"}
+    except Exception as e:
+        # 接続エラーやサーキットブレーカーなども、応答の表示を終わらせるためにエラーとして送る
+        yield {"type": "error", "content": f"エラーが発生しました: {str(e)}"}
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
+    connection = connections.register(websocket, endpoint="/ws")
     
     # 最初にサポート選択画面を送信
-    await websocket.send_text(json.dumps({
+    await connection.send_json({
         "type": "support_select",
         "options": [
             {"id": "general", "name": "一般的な質問"},
             {"id": "technical", "name": "技術的な質問"},
             {"id": "other", "name": "その他"}
         ]
-    }))
+    })
     
-    while True:
-        try:
-            data = await websocket.receive_json()
+    try:
+        while True:
+            data = await connection.receive_json()
+            request_id = data.get("request_id") or new_request_id()
             
             if data.get("type") == "support_select":
                 # サポートタイプが選択された
                 support_type = data.get("selected")
-                await websocket.send_text(json.dumps({
+                await connection.send_json({
                     "type": "message",
+                    "request_id": request_id,
                     "text": f"{support_type}のサポートを開始します。ご質問をどうぞ。"
-                }))
+                })
                 
-            elif data.get("type") == "message":
-                # 通常のメッセージ
-                message = data.get("text", "")
+            elif data.get("type") == "ping":
+                await connection.send_json({"type": "pong", "request_id": request_id})
+                
+            elif data.get("type") == "pong":
+                # サーバーからのpingへの応答（受信時刻は receive_json で記録済み）
+                pass
                 
-                # Dify APIを呼び出し
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(
-                        "https://api.dify.ai/v1/chat-messages",
-                        headers={
-                            "Authorization": f"Bearer {os.getenv('DIFY_API_KEY')}",
-                            "Content-Type": "application/json"
-                        },
-                        json={
-                            "inputs": {},
-                            "query": message,
-                            "response_mode": "blocking"
-                        }
-                    )
-                    
-                    if response.status_code == 200:
-                        bot_message = response.json()["answer"]
-                    else:
-                        bot_message = f"エラーが発生しました: {response.status_code}"
-                    
-                await websocket.send_text(json.dumps({
-                    "type": "message", 
-                    "text": bot_message
-                }))
+            elif data.get("type") == "message":
+                # 通常のメッセージ（別タスクで処理し、応答には request_id を付ける）
+                frames = _stream_reply(data.get("text", ""))
+                if not connection.dispatch(request_id, frames):
+                    await frames.aclose()
+                    await connection.reject(request_id)
                 
-        except Exception as e:
-            print(f"Error: {e}")
-            break
+    except Exception as e:
+        print(f"Error: {e}")
+    finally:
+        await connections.unregister(connection)
 
 async def call_mistral(message: str) -> str:
     """Mistral APIを呼び出す関数"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://api.mistral.ai/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {os.getenv('MISTRAL_API_KEY')}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "mistral-tiny",
-                    "messages": [{"role": "user", "content": message}]
-                }
-            )
+        response = await http_clients.get("mistral").post(
+            "https://api.mistral.ai/v1/chat/completions",
+            headers={
+                "Authorization": f"Bearer {os.getenv('MISTRAL_API_KEY')}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "model": "mistral-tiny",
+                "messages": [{"role": "user", "content": message}]
+            }
+        )
+        
+        if response.status_code == 200:
+            return response.json()["choices"][0]["message"]["content"]
+        else:
+            return f"エラーが発生しました: {response.status_code}"
             
-            if response.status_code == 200:
-                return response.json()["choices"][0]["message"]["content"]
-            else:
-                return f"エラーが発生しました: {response.status_code}"
-                
     except Exception as e:
         return f"エラーが発生しました: {str(e)}"
 
@@ -501,6 +737,23 @@ async def test_dify(mode: str, message: str):
     response = await client.send_message(message)
     return response
 
+async def _publish_conversations_changed(user_id: Optional[str], conversation_id: int):
+    """会話一覧の変更を、利用者の接続中のWebSocket（/ws/{user_id}）すべてに知らせる
+
+    どのワーカーに接続していても届く（WS_ROUTING_BACKEND）。受け取ったクライアントは
+    会話一覧を取得し直す（変更がなければETagで304になる）。
+    """
+    if user_id is None:
+        return
+    try:
+        await chat_router.manager.send_message(
+            {"type": "conversations_changed", "conversation_id": conversation_id},
+            user_id
+        )
+    except Exception as e:
+        # 通知に失敗しても書き込み自体は成功しているため、エラーにはしない
+        logger.warning(f"Failed to publish conversation update for user {user_id}: {str(e)}")
+
 @app.get("/test")
 async def test_endpoint():
     return {"message": "Server is running"}
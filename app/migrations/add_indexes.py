@@ -0,0 +1,44 @@
+from sqlalchemy import text
+from app.database import engine
+
+# app/database.py の __table_args__ と同じ定義
+INDEXES = {
+    "ix_conversations_user_pinned_created": "conversations (user_id, is_pinned, created_at)",
+    "ix_conversations_user_created": "conversations (user_id, created_at)",
+    "ix_messages_conversation_created": "messages (conversation_id, created_at)",
+    "ix_messages_conversation_id": "messages (conversation_id, id)",
+    "ix_token_reservations_created": "token_reservations (created_at)",
+}
+
+def upgrade():
+    with engine.connect() as conn:
+        try:
+            # 既存のテーブルとインデックスを確認
+            result = conn.execute(text("SELECT type, name FROM sqlite_master WHERE type IN ('table', 'index')"))
+            rows = result.fetchall()
+            tables = {name for type_, name in rows if type_ == "table"}
+            existing = {name for type_, name in rows if type_ == "index"}
+            
+            for name, definition in INDEXES.items():
+                if name in existing:
+                    print(f"Index {name} already exists")
+                    continue
+                table = definition.split(" ", 1)[0]
+                if table not in tables:
+                    # まだないテーブルは、アプリの起動時に create_all がインデックスと一緒に作成する
+                    print(f"Table {table} does not exist, skipping index {name}")
+                    continue
+                conn.execute(text(f"CREATE INDEX {name} ON {definition}"))
+                print(f"Successfully created index {name}")
+            
+            # クエリプランナー用の統計情報を更新
+            conn.execute(text("ANALYZE"))
+            conn.commit()
+                
+        except Exception as e:
+            print(f"Migration failed: {str(e)}")
+            conn.rollback()
+            raise
+
+if __name__ == "__main__":
+    upgrade()
@@ -1,7 +1,6 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from sqlalchemy.exc import OperationalError
-
-engine = create_engine('sqlite:///./test.db')
+from app.database import engine
 
 def upgrade():
     with engine.connect() as conn:
@@ -0,0 +1,34 @@
+from sqlalchemy import text
+from app.database import MESSAGE_SEARCH_DDL, engine
+
+def upgrade():
+    with engine.connect() as conn:
+        try:
+            # 検索用のテーブルがあるか確認
+            result = conn.execute(text(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+            ))
+            exists = result.first() is not None
+            
+            # app/database.py と同じ定義でテーブルとトリガーを作成（既存のものはそのまま）
+            for statement in MESSAGE_SEARCH_DDL:
+                conn.execute(text(statement))
+            
+            # 既存のメッセージを索引に登録（作り直すため、何度実行してもよい）
+            conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+            conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('optimize')"))
+            conn.commit()
+            
+            count = conn.execute(text("SELECT count(*) FROM messages")).scalar()
+            if exists:
+                print(f"Table messages_fts already exists; rebuilt index for {count} messages")
+            else:
+                print(f"Successfully created messages_fts and indexed {count} messages")
+                
+        except Exception as e:
+            print(f"Migration failed: {str(e)}")
+            conn.rollback()
+            raise
+
+if __name__ == "__main__":
+    upgrade()
@@ -0,0 +1,60 @@
+"""キーセット（カーソル）ページネーション用のカーソル"""
+from datetime import datetime
+from typing import Optional, Tuple
+import base64
+import json
+from fastapi import HTTPException
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(*values) -> str:
+    """ソートキーの値を不透明なカーソル文字列にする"""
+    raw = json.dumps(
+        [v.isoformat() if isinstance(v, datetime) else v for v in values],
+        separators=(",", ":")
+    )
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def _decode(cursor: str) -> list:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list):
+            raise ValueError
+        return values
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def decode_conversation_cursor(cursor: Optional[str]) -> Optional[Tuple[bool, datetime, int]]:
+    """(is_pinned, created_at, id)"""
+    if cursor is None:
+        return None
+    values = _decode(cursor)
+    try:
+        is_pinned, created_at, conversation_id = values
+        return bool(is_pinned), datetime.fromisoformat(created_at), int(conversation_id)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def decode_message_cursor(cursor: Optional[str]) -> Optional[Tuple[datetime, int]]:
+    """(created_at, id)"""
+    if cursor is None:
+        return None
+    values = _decode(cursor)
+    try:
+        created_at, message_id = values
+        return datetime.fromisoformat(created_at), int(message_id)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def decode_search_cursor(cursor: Optional[str]) -> Optional[Tuple[float, int]]:
+    """(rank, id)"""
+    if cursor is None:
+        return None
+    values = _decode(cursor)
+    try:
+        rank, message_id = values
+        return float(rank), int(message_id)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
@@ -0,0 +1,277 @@
+"""非同期のデータアクセス関数（会話・メッセージ・検索・トークン使用量）"""
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import DateTime, Float, delete, select, text, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from .database import Conversation, Message, TokenReservation, TokenUsage
+from . import search
+
+DEFAULT_TOKENS = 200
+
+# --- 会話 ---
+
+async def get_conversation(db: AsyncSession, conversation_id: int) -> Optional[Conversation]:
+    return await db.get(Conversation, conversation_id)
+
+async def get_latest_conversation(db: AsyncSession, user_id: str) -> Optional[Conversation]:
+    result = await db.execute(
+        select(Conversation)
+        .where(Conversation.user_id == user_id)
+        .order_by(Conversation.created_at.desc())
+        .limit(1)
+    )
+    return result.scalars().first()
+
+async def list_conversations(
+    db: AsyncSession,
+    user_id: str,
+    limit: Optional[int] = None,
+    after: Optional[Tuple[bool, datetime, int]] = None,
+    before: Optional[Tuple[bool, datetime, int]] = None
+) -> List[Conversation]:
+    """会話一覧を (is_pinned desc, created_at desc, id desc) の順で取得
+
+    after/before はソートキー (is_pinned, created_at, id) で、一覧上でそのキーより
+    後ろ／前の会話を返す（キーセットページネーション）。
+    """
+    key = tuple_(Conversation.is_pinned, Conversation.created_at, Conversation.id)
+    query = select(Conversation).where(Conversation.user_id == user_id)
+    if after is not None:
+        query = query.where(key < tuple_(*after))
+    if before is not None:
+        query = query.where(key > tuple_(*before))
+
+    # beforeのみ指定された場合は逆順に読み、最後に並べ直す
+    reverse = before is not None and after is None
+    if reverse:
+        query = query.order_by(
+            Conversation.is_pinned, Conversation.created_at, Conversation.id
+        )
+    else:
+        query = query.order_by(
+            Conversation.is_pinned.desc(),  # ピン留めを優先
+            Conversation.created_at.desc(),
+            Conversation.id.desc()
+        )
+    if limit is not None:
+        query = query.limit(limit)
+
+    result = await db.execute(query)
+    conversations = list(result.scalars().all())
+    if reverse:
+        conversations.reverse()
+    return conversations
+
+async def create_conversation(
+    db: AsyncSession,
+    user_id: str,
+    title: str,
+    commit: bool = True,
+    **fields
+) -> Conversation:
+    conversation = Conversation(user_id=user_id, title=title, **fields)
+    db.add(conversation)
+    if commit:
+        await db.commit()
+    else:
+        await db.flush()  # IDを採番する
+    return conversation
+
+async def delete_conversation(db: AsyncSession, conversation: Conversation):
+    """会話と関連するメッセージを削除"""
+    await db.execute(
+        delete(Message).where(Message.conversation_id == conversation.id)
+    )
+    await db.delete(conversation)
+    await db.commit()
+
+# --- メッセージ ---
+
+async def list_messages(
+    db: AsyncSession,
+    conversation_id: int,
+    limit: Optional[int] = None,
+    after: Optional[Tuple[datetime, int]] = None,
+    before: Optional[Tuple[datetime, int]] = None
+) -> List[Message]:
+    """会話のメッセージを (created_at, id) の昇順で取得
+
+    after を指定するとそのキーより新しいメッセージを古い順に、limit のみ／before を
+    指定すると最新（またはbeforeより古い）limit件を返す。
+    """
+    key = tuple_(Message.created_at, Message.id)
+    query = select(Message).where(Message.conversation_id == conversation_id)
+    if after is not None:
+        query = query.where(key > tuple_(*after))
+    if before is not None:
+        query = query.where(key < tuple_(*before))
+
+    # 末尾からlimit件を読む場合は降順に読み、最後に並べ直す
+    reverse = limit is not None and after is None
+    if reverse:
+        query = query.order_by(Message.created_at.desc(), Message.id.desc())
+    else:
+        query = query.order_by(Message.created_at, Message.id)
+    if limit is not None:
+        query = query.limit(limit)
+
+    result = await db.execute(query)
+    messages = list(result.scalars().all())
+    if reverse:
+        messages.reverse()
+    return messages
+
+async def list_messages_since(
+    db: AsyncSession,
+    conversation_id: int,
+    since_id: int,
+    limit: Optional[int] = None
+) -> List[Message]:
+    """会話のメッセージのうち、idがsince_idより大きいものをidの昇順で取得"""
+    query = (
+        select(Message)
+        .where(Message.conversation_id == conversation_id, Message.id > since_id)
+        .order_by(Message.id)
+    )
+    if limit is not None:
+        query = query.limit(limit)
+    result = await db.execute(query)
+    return list(result.scalars().all())
+
+async def add_message(
+    db: AsyncSession,
+    conversation_id: int,
+    content: str,
+    role: str,
+    commit: bool = True
+) -> Message:
+    message = Message(conversation_id=conversation_id, content=content, role=role)
+    db.add(message)
+    if commit:
+        await db.commit()
+    return message
+
+# --- 検索 ---
+
+_FTS_SEARCH_SQL = """
+    SELECT m.id, m.conversation_id, c.title, m.role, m.created_at,
+           snippet(messages_fts, 0, :mark_start, :mark_end, '…', 32) AS snippet,
+           messages_fts.rank AS rank
+    FROM messages_fts
+    JOIN messages AS m ON m.id = messages_fts.rowid
+    JOIN conversations AS c ON c.id = m.conversation_id
+    WHERE messages_fts MATCH :match AND c.user_id = :user_id {after}
+    ORDER BY messages_fts.rank, m.id DESC
+    LIMIT :limit
+"""
+
+async def search_messages(
+    db: AsyncSession,
+    user_id: str,
+    query: str,
+    limit: int,
+    after: Optional[Tuple[float, int]] = None
+) -> List[Dict[str, Any]]:
+    """利用者のメッセージを全文検索し、関連度順（同じ場合は新しい順）に返す
+
+    after は直前のページの最後の結果の (rank, id)。rankはbm25（小さいほど関連度が高い）。
+    LIKE検索になった場合のrankは0で、新しい順に返す。
+    """
+    terms = search.parse_terms(query)
+    if not terms:
+        return []
+
+    match = search.fts_match_expression(terms)
+    if match is not None:
+        after_clause = ""
+        params = {
+            "match": match,
+            "user_id": user_id,
+            "limit": limit,
+            "mark_start": search.MARK_START,
+            "mark_end": search.MARK_END,
+        }
+        if after is not None:
+            after_clause = (
+                "AND (messages_fts.rank > :after_rank"
+                " OR (messages_fts.rank = :after_rank AND m.id < :after_id))"
+            )
+            params.update(after_rank=after[0], after_id=after[1])
+        statement = text(_FTS_SEARCH_SQL.format(after=after_clause)).columns(
+            created_at=DateTime, rank=Float
+        )
+        rows = (await db.execute(statement, params)).mappings().all()
+        return [
+            {**row, "snippet": search.marked_to_html(row["snippet"])}
+            for row in rows
+        ]
+
+    # 3文字未満の語を含む場合は、利用者の会話のメッセージに限定してLIKEで探す
+    statement = (
+        select(
+            Message.id,
+            Message.conversation_id,
+            Conversation.title,
+            Message.role,
+            Message.created_at,
+            Message.content
+        )
+        .join(Conversation, Conversation.id == Message.conversation_id)
+        .where(Conversation.user_id == user_id)
+    )
+    for term in terms:
+        statement = statement.where(Message.content.like(search.like_pattern(term), escape="\\"))
+    if after is not None:
+        statement = statement.where(Message.id < after[1])
+    statement = statement.order_by(Message.id.desc()).limit(limit)
+    rows = (await db.execute(statement)).mappings().all()
+    return [
+        {
+            "id": row["id"],
+            "conversation_id": row["conversation_id"],
+            "title": row["title"],
+            "role": row["role"],
+            "created_at": row["created_at"],
+            "snippet": search.snippet(row["content"], terms),
+            "rank": 0.0,
+        }
+        for row in rows
+    ]
+
+# --- トークン使用量 ---
+
+async def get_token_usage(db: AsyncSession, user_id: str) -> Optional[TokenUsage]:
+    result = await db.execute(
+        select(TokenUsage).where(TokenUsage.user_id == user_id).limit(1)
+    )
+    return result.scalars().first()
+
+async def get_or_create_token_usage(
+    db: AsyncSession,
+    user_id: str,
+    remaining_tokens: int = DEFAULT_TOKENS,
+    commit: bool = True
+) -> TokenUsage:
+    """新規ユーザーの場合は初期トークンを設定"""
+    usage = await get_token_usage(db, user_id)
+    if usage is None:
+        usage = TokenUsage(user_id=user_id, remaining_tokens=remaining_tokens)
+        db.add(usage)
+        if commit:
+            await db.commit()
+        else:
+            await db.flush()
+    return usage
+
+async def reset_token_usage(db: AsyncSession, user_id: str) -> TokenUsage:
+    """残量を初期値に戻す（精算前の予約も取り消し、リセット後の精算で返却されないようにする）"""
+    await db.execute(delete(TokenReservation).where(TokenReservation.user_id == user_id))
+    usage = await get_token_usage(db, user_id)
+    if usage:
+        usage.remaining_tokens = DEFAULT_TOKENS
+        usage.last_updated = datetime.utcnow()
+    else:
+        usage = TokenUsage(user_id=user_id, remaining_tokens=DEFAULT_TOKENS)
+        db.add(usage)
+    await db.commit()
+    return usage
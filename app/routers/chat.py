@@ -1,10 +1,11 @@
 from fastapi import APIRouter, FastAPI, WebSocket, WebSocketDisconnect, HTTPException  # HTTPExceptionを追加
-from typing import Dict
-import httpx  # aiohttpの代わりにhttpxを使用
-import json
-import os
+from typing import AsyncIterator
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware  # 追加
+from ..services.dify.client import DifyClient
+from ..services.dify.streaming import stream_frames
+from ..services.connections import Connection, connections, new_request_id
+from ..services.routing import routing_backend
 
 load_dotenv()
 router = APIRouter()
@@ -22,85 +23,73 @@ app.add_middleware(
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.api_key = os.getenv("DIFY_API_KEY")  # 環境変数からAPIキーを取得
+        # 接続は共有のレジストリで管理する（利用者ごとに複数の接続を保持し、無応答の接続は切断する）
+        self.registry = connections
+        # 他のワーカーに接続している利用者にも届ける配信方式（WS_ROUTING_BACKEND）
+        self.backend = routing_backend
+        self.dify = DifyClient()  # DIFY_API_KEY（defaultモード）を使用
         
-    async def connect(self, websocket: WebSocket, user_id: str):
+    async def connect(self, websocket: WebSocket, user_id: str) -> Connection:
         await websocket.accept()
-        self.active_connections[user_id] = websocket
+        return self.registry.register(websocket, user_id, endpoint="/ws/{user_id}")
         
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-            
-    async def send_message(self, message: dict, user_id: str):
-        if user_id in self.active_connections:
-            await self.active_connections[user_id].send_json(message)
+    async def disconnect(self, connection: Connection):
+        await self.registry.unregister(connection)
 
-    async def _call_dify_api(self, message: str, user_id: str) -> dict:  # クラス内のメソッドとして定義
-        """Dify APIとの実際の通信処理"""
-        url = "https://api.dify.ai/v1/chat-messages"
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        payload = {
-            "inputs": {},
-            "query": message,
-            "user": user_id,
-            "response_mode": "blocking",
-            "conversation_id": None  # 必要に応じて会話IDを管理
-        }
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=payload, headers=headers)
-            if response.status_code == 200:
-                return response.json()
-            else:
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=f"Dify API error: {response.text}"
-                )
+    async def send_message(self, message: dict, user_id: str):
+        """利用者のすべての接続に送信（どのワーカーに接続していても届く）"""
+        await self.backend.publish(user_id, message)
 
-    async def send_to_dify(self, message: str, user_id: str) -> dict:
+    async def stream_to_dify(self, message: str, user_id: str) -> AsyncIterator[dict]:
+        """Difyの応答を `start`、まとめた断片の `delta`、全文と使用量の `end` の順に返す"""
         try:
-            response = await self._call_dify_api(message, user_id)
-            return {
-                "type": "bot",
-                "content": response.get("answer", "応答がありません"),
-                "conversation_id": response.get("conversation_id")
-            }
+            async for frame in stream_frames(self.dify.stream_message(message, user=user_id)):
+                yield frame
         except Exception as e:
-            return {
+            yield {
                 "type": "error",
                 "content": f"エラーが発生しました: {str(e)}"
             }
 
 manager = ConnectionManager()
 
+@router.get("/connections/stats")
+async def get_connection_stats():
+    """WebSocket接続数と接続あたりのおおよそのメモリ使用量を取得"""
+    return manager.registry.stats()
+
 @router.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    await manager.connect(websocket, user_id)
+    connection = await manager.connect(websocket, user_id)
     try:
         while True:
-            data = await websocket.receive_json()
+            data = await connection.receive_json()
+            request_id = data.get("request_id") or new_request_id()
+
+            if data.get("type") == "ping":
+                await connection.send_json({"type": "pong", "request_id": request_id})
+                continue
+            if data.get("type") == "pong":
+                # サーバーからのpingへの応答（受信時刻は receive_json で記録済み）
+                continue
             
-            # メッセージを処理してDify APIに送信
-            response = await manager.send_to_dify(
+            # メッセージごとに別タスクでDify APIに送信し、応答を request_id 付きで届いた順に送信
+            frames = manager.stream_to_dify(
                 message=data.get("message", ""),
                 user_id=user_id
             )
-            
-            # 応答をクライアントに送信
-            await manager.send_message(response, user_id)
+            if not connection.dispatch(request_id, frames):
+                await frames.aclose()
+                await connection.reject(request_id)
                 
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
+        pass
     except Exception as e:
-        await manager.send_message(
-            {
-                "type": "error",
-                "content": f"エラーが発生しました: {str(e)}"
-            },
-            user_id
-        )
+        # 切断すると送信待ちは破棄されるため、エラーを届けてから切断する
+        if connection.send_nowait({
+            "type": "error",
+            "content": f"エラーが発生しました: {str(e)}"
+        }):
+            await connection.drain(timeout=1.0)
+    finally:
+        await manager.disconnect(connection)
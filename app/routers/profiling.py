@@ -0,0 +1,30 @@
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+from typing import Optional
+from ..services.profiler import check_admin_token, profiler
+
+# PROFILING_ENABLED=1 のときだけ登録する
+router = APIRouter(prefix="/admin/profiles", tags=["admin"])
+
+def _check_token(token: Optional[str]):
+    # PROFILE_ADMIN_TOKEN はプロファイリングを有効にする際に必須（services/profiler.py）
+    if not check_admin_token(token):
+        raise HTTPException(status_code=403, detail="管理用トークンが正しくありません")
+
+@router.get("")
+async def list_profiles(x_admin_token: Optional[str] = Header(None)):
+    """保持しているプロファイルの一覧（新しい順）"""
+    _check_token(x_admin_token)
+    return [profile.summary() for profile in reversed(profiler.profiles)]
+
+@router.get("/{profile_id}")
+async def download_profile(profile_id: int, x_admin_token: Optional[str] = Header(None)):
+    """プロファイルをfolded形式でダウンロード（flamegraph.pl / speedscope で表示できる）"""
+    _check_token(x_admin_token)
+    profile = profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(
+        profile.folded(),
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.folded"'}
+    )
@@ -1,9 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from ..database import get_db, Conversation
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from ..database import Conversation
+from ..services import versions
+from ..services.writer import writer
 from ..services.dify.client import DifyClient
+from ..services.dify.cache import answer_cache
+from ..services.dify.limiter import bulkheads
+from ..services.dify.resilience import circuit_breakers
 from typing import Optional
 from pydantic import BaseModel
+import json
 
 router = APIRouter(prefix="/support", tags=["support"])
 
@@ -11,6 +17,7 @@ class ChatRequest(BaseModel):
     message: str
     conversation_id: Optional[str] = None
     mode: Optional[str] = 'default'
+    stream: bool = True  # Falseの場合は従来どおりblockingモードで応答全体を返す
 
 @router.get("/bots")
 async def get_available_bots():
@@ -33,44 +40,102 @@ async def get_available_bots():
         }
     ]
 
+@router.get("/cache/stats")
+async def get_cache_stats():
+    """応答キャッシュのヒット率などを取得"""
+    return answer_cache.stats()
+
+@router.get("/limits")
+async def get_limits():
+    """ボットモードごとの同時実行数と待ち行列の状況を取得"""
+    return bulkheads.stats()
+
+@router.get("/circuits")
+async def get_circuits():
+    """ボットモードごとのサーキットブレーカーの状態を取得"""
+    return circuit_breakers.stats()
+
 @router.post("/select/{bot_id}")
 async def select_bot(bot_id: str):
     """特定のボットを選択"""
     return {"status": "success", "selected_bot_id": bot_id}
 
 @router.post("/proxy/dify")
-async def proxy_dify(
-    request: ChatRequest,
-    db: Session = Depends(get_db)
-):
+async def proxy_dify(request: ChatRequest):
     try:
         # DifyClientのインスタンス化
         client = DifyClient(mode=request.mode)
-        
-        # Dify APIへのリクエスト
-        response = await client.send_message(
+
+        if not request.stream:
+            # Dify APIへのリクエスト（blockingモード）
+            response = await client.send_message(
+                query=request.message,
+                conversation_id=request.conversation_id
+            )
+            _save_new_conversation(request, response.get('conversation_id'))
+            return response
+
+        # 最初のイベントまで待ってからレスポンスを開始する
+        # （接続エラーやステータスエラーはここで通常のHTTPエラーになる）
+        events = client.stream_message(
             query=request.message,
             conversation_id=request.conversation_id
         )
-        
-        # レスポンスからDifyの会話IDを取得
-        dify_conversation_id = response.get('conversation_id')
-        
-        if not request.conversation_id and dify_conversation_id:
-            # 新規会話の場合、データベースに保存
-            conversation = Conversation(
-                user_id="test_user",  # 後で認証システムと連携
-                title=request.message[:50],  # 最初のメッセージを会話タイトルとして使用
-                dify_conversation_id=dify_conversation_id,
-                mode=request.mode
-            )
-            db.add(conversation)
-            db.commit()
-        
-        return response
-        
+        first_event = await events.__anext__()
+
+    except StopAsyncIteration:
+        raise HTTPException(status_code=502, detail="Dify APIから応答がありません")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Dify APIエラー: {str(e)}"
-        ) 
\ No newline at end of file
+        )
+
+    async def event_stream():
+        saved = False
+        event = first_event
+        try:
+            while True:
+                # レスポンスからDifyの会話IDを取得し、新規会話なら一度だけ保存
+                if not saved and event.get('conversation_id'):
+                    _save_new_conversation(request, event['conversation_id'])
+                    saved = True
+
+                yield _format_sse(event)
+                event = await events.__anext__()
+        except StopAsyncIteration:
+            pass
+        except Exception as e:
+            # ヘッダー送信後なのでエラーもSSEイベントとして返す
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            yield _format_sse({"event": "error", "message": f"Dify APIエラー: {detail}"})
+        finally:
+            await events.aclose()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def _save_new_conversation(request: ChatRequest, dify_conversation_id: Optional[str]):
+    """新規会話の場合、データベースに保存（書き込みキューに入れ、コミットは待たない）"""
+    if request.conversation_id or not dify_conversation_id:
+        return
+    user_id = "test_user"  # 後で認証システムと連携
+
+    async def write(session):
+        session.add(Conversation(
+            user_id=user_id,
+            title=request.message[:50],  # 最初のメッセージを会話タイトルとして使用
+            dify_conversation_id=dify_conversation_id,
+            mode=request.mode
+        ))
+        await versions.bump(session, user_id=user_id)
+
+    writer.submit_detached(write)
+
+def _format_sse(event: dict) -> str:
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
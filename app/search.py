@@ -0,0 +1,45 @@
+"""メッセージ検索の検索語の解析と強調表示
+
+検索語は空白で区切り、すべてを含むメッセージを探す（AND）。FTS5のtrigram索引は
+3文字未満の語を検索できないため、その場合は利用者の会話に限定したLIKE検索にする。
+"""
+from typing import List, Optional
+import html
+import re
+
+MIN_FTS_TERM_LENGTH = 3
+SNIPPET_CHARS = 40  # 一致箇所の前後に表示する文字数の目安
+
+# FTS5のhighlight/snippetが一致箇所の前後に挿入する印（表示前にHTMLの<mark>に置き換える）
+MARK_START = "\x02"
+MARK_END = "\x03"
+
+def parse_terms(query: str) -> List[str]:
+    return [term for term in re.split(r"\s+", query.strip()) if term]
+
+def fts_match_expression(terms: List[str]) -> Optional[str]:
+    """FTS5のMATCH式（各語をフレーズとして扱い、演算子は解釈しない）。使えない場合はNone"""
+    if not terms or any(len(term) < MIN_FTS_TERM_LENGTH for term in terms):
+        return None
+    return " AND ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+def like_pattern(term: str) -> str:
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+def marked_to_html(text: str) -> str:
+    """印の付いたテキストをエスケープし、一致箇所を<mark>で囲む"""
+    escaped = html.escape(text or "")
+    return escaped.replace(MARK_START, "<mark>").replace(MARK_END, "</mark>")
+
+def snippet(content: str, terms: List[str]) -> str:
+    """LIKE検索の結果用に、最初の一致箇所の周辺を切り出して強調する"""
+    content = content or ""
+    pattern = re.compile("|".join(re.escape(term) for term in terms), re.IGNORECASE)
+    first = pattern.search(content)
+    start = max(0, first.start() - SNIPPET_CHARS) if first else 0
+    end = min(len(content), (first.end() if first else 0) + SNIPPET_CHARS)
+    excerpt = pattern.sub(lambda m: MARK_START + m.group(0) + MARK_END, content[start:end])
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if end < len(content) else ""
+    return marked_to_html(prefix + excerpt + suffix)
@@ -0,0 +1,175 @@
+"""静的ファイル（static/）の配信
+
+起動時に static/ のファイルをすべてメモリに読み込み、次の準備をしておく（リクエストごとの
+ディスクI/Oや圧縮はしない）:
+- gzip（brotliがインストールされていればbrも）で事前に圧縮する（小さくならない場合は圧縮しない）
+- 内容のハッシュを付けた名前（script.js → script.<hash>.js）でも配信し、index.html の
+  /static/... への参照をその名前に書き換える
+
+ハッシュ付きの名前は内容が変われば名前も変わるため、1年間・immutableでキャッシュさせる。
+index.html と元の名前は毎回ETagで確認させる。Accept-Encodingに応じて圧縮済みのものを返す。
+static/ のファイルを変更した場合は再起動が必要。
+"""
+from typing import Dict, Optional
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+
+try:
+    import brotli
+except ImportError:  # 任意の依存関係（なければgzipのみ）
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.getenv("STATIC_DIR", "static")
+STATIC_PREFIX = "/static/"
+INDEX_NAME = "index.html"
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+_REFERENCE = re.compile(re.escape(STATIC_PREFIX) + r"([\w./-]+)")
+
+class Asset:
+    __slots__ = ("media_type", "etag", "cache_control", "bodies")
+
+    def __init__(self, body: bytes, media_type: str, cache_control: str):
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.etag = hashlib.sha256(body).hexdigest()[:16]
+        # Content-Encoding（識別なしは""）→ 本文。優先する順に並べる
+        self.bodies: Dict[str, bytes] = {}
+        if brotli is not None:
+            compressed = brotli.compress(body, quality=11)
+            if len(compressed) < len(body):
+                self.bodies["br"] = compressed
+        compressed = gzip.compress(body, compresslevel=9, mtime=0)
+        if len(compressed) < len(body):
+            self.bodies["gzip"] = compressed
+        self.bodies[""] = body
+
+    def negotiate(self, accept_encoding: str) -> str:
+        accepted = _accepted_encodings(accept_encoding)
+        for encoding in self.bodies:
+            if encoding and encoding in accepted:
+                return encoding
+        return ""
+
+    def response(self, request: Request) -> Response:
+        encoding = self.negotiate(request.headers.get("accept-encoding", ""))
+        # 圧縮形式ごとに内容が違うため、ETagも区別する
+        etag = f'"{self.etag}-{encoding}"' if encoding else f'"{self.etag}"'
+        headers = {
+            "ETag": etag,
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if etag in _if_none_match(request):
+            return Response(status_code=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        body = self.bodies[encoding]
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            body = b""
+        return Response(body, media_type=self.media_type, headers=headers)
+
+class StaticAssets:
+    """/static にマウントするASGIアプリ（load() の後に使う）"""
+
+    def __init__(self, directory: str = STATIC_DIR):
+        self.directory = directory
+        self.assets: Dict[str, Asset] = {}
+        self.fingerprints: Dict[str, str] = {}  # 元の名前 → ハッシュ付きの名前
+
+    def load(self):
+        assets: Dict[str, Asset] = {}
+        fingerprints: Dict[str, str] = {}
+        sources: Dict[str, bytes] = {}
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                path = os.path.join(root, file)
+                with open(path, "rb") as f:
+                    sources[os.path.relpath(path, self.directory).replace(os.sep, "/")] = f.read()
+
+        for name, body in sources.items():
+            if name == INDEX_NAME:
+                continue
+            media_type = _media_type(name)
+            base, ext = os.path.splitext(name)
+            fingerprinted = f"{base}.{hashlib.sha256(body).hexdigest()[:12]}{ext}"
+            fingerprints[name] = fingerprinted
+            assets[fingerprinted] = Asset(body, media_type, IMMUTABLE_CACHE_CONTROL)
+            assets[name] = Asset(body, media_type, REVALIDATE_CACHE_CONTROL)
+
+        if INDEX_NAME in sources:
+            html = _REFERENCE.sub(
+                lambda m: STATIC_PREFIX + fingerprints.get(m.group(1), m.group(1)),
+                sources[INDEX_NAME].decode("utf-8")
+            ).encode("utf-8")
+            assets[INDEX_NAME] = Asset(html, _media_type(INDEX_NAME), REVALIDATE_CACHE_CONTROL)
+
+        self.assets = assets
+        self.fingerprints = fingerprints
+        logger.info(
+            f"Loaded {len(sources)} static files "
+            f"({sum(len(b) for b in sources.values())} bytes, brotli={'on' if brotli else 'off'})"
+        )
+
+    def get(self, name: str) -> Optional[Asset]:
+        return self.assets.get(name)
+
+    def index(self, request: Request) -> Response:
+        asset = self.get(INDEX_NAME)
+        if asset is None:
+            return PlainTextResponse("Not Found", status_code=404)
+        return asset.response(request)
+
+    async def __call__(self, scope, receive, send):
+        request = Request(scope, receive)
+        asset = self.get(scope["path"].lstrip("/"))
+        if request.method not in ("GET", "HEAD"):
+            response = PlainTextResponse("Method Not Allowed", status_code=405)
+        elif asset is None:
+            response = PlainTextResponse("Not Found", status_code=404)
+        else:
+            response = asset.response(request)
+        await response(scope, receive, send)
+
+def _media_type(name: str) -> str:
+    # text/* にはResponseがcharsetを付ける
+    media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    if media_type in ("application/javascript", "application/json"):
+        media_type += "; charset=utf-8"
+    return media_type
+
+def _accepted_encodings(header: str) -> set:
+    """Accept-Encodingのうち、q=0でないもの"""
+    accepted = set()
+    for part in header.split(","):
+        encoding, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if encoding and q > 0:
+            accepted.add(encoding.strip().lower())
+    if "*" in accepted:
+        accepted.update(("br", "gzip"))
+    return accepted
+
+def _if_none_match(request: Request) -> set:
+    header = request.headers.get("if-none-match", "")
+    return {tag.strip().removeprefix("W/") for tag in header.split(",") if tag.strip()}
+
+static_assets = StaticAssets()
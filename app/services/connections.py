@@ -0,0 +1,297 @@
+"""WebSocket接続の登録と、接続ごとのメッセージの並行処理
+
+クライアントは各メッセージに `request_id` を付けて送る（省略時はサーバーで採番する）。
+メッセージはそれぞれ別のタスクで処理し、応答フレームには同じ `request_id` を付けて
+完了した順に返す。1つの接続で同時に処理するメッセージ数は WS_MAX_CONCURRENCY まで。
+`{"type": "ping"}` には処理中のメッセージを待たずに `{"type": "pong"}` を返す。
+
+多数の（ほとんどが待機中の）接続を保持するため:
+- 接続ごとの状態は __slots__ で持ち、送信用のタスクは送信待ちがある間だけ動かす
+- ハートビートと切断は接続ごとのタイマーではなく、1つのバックグラウンドタスクでまとめて行う
+  （WS_HEARTBEAT_INTERVAL 秒受信がなければ `{"type": "ping"}` を送り、WS_PONG_TIMEOUT 秒以内に
+  何も受信しなければ切断する。WS_IDLE_TIMEOUT 秒メッセージがなければ切断する）
+- 送信待ちは WS_SEND_QUEUE_SIZE 件まで。自分のリクエストへの応答は空くまで待ち（背圧）、
+  他からの送信（send_to_user）は待たずに、溢れた接続を切断する
+"""
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, Optional, Set
+import asyncio
+import itertools
+import logging
+import sys
+import time
+import uuid
+from fastapi import WebSocket
+from ..config import (
+    WS_HEARTBEAT_INTERVAL,
+    WS_IDLE_TIMEOUT,
+    WS_MAX_CONCURRENCY,
+    WS_PONG_TIMEOUT,
+    WS_SEND_QUEUE_SIZE,
+)
+from .metrics import websocket_connections_active
+
+logger = logging.getLogger(__name__)
+
+_connection_ids = itertools.count(1)
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex
+
+class ConnectionClosed(Exception):
+    pass
+
+class Connection:
+    __slots__ = (
+        "id",
+        "websocket",
+        "user_id",
+        "endpoint",
+        "tasks",
+        "queue",
+        "writer",
+        "space",
+        "closed",
+        "last_received",
+        "last_active",
+        "pinged_at",
+    )
+
+    def __init__(self, websocket: WebSocket, user_id: Optional[str] = None, endpoint: str = ""):
+        now = time.monotonic()
+        self.id = next(_connection_ids)
+        self.websocket = websocket
+        self.user_id = user_id
+        self.endpoint = endpoint
+        self.tasks: Optional[Set[asyncio.Task]] = None  # 処理中のメッセージがある間だけ作る
+        self.queue: Deque[Dict[str, Any]] = deque()
+        self.writer: Optional[asyncio.Task] = None
+        self.space: Optional[asyncio.Future] = None  # 送信待ちが空くのを待つ側のFuture
+        self.closed = False
+        self.last_received = now  # 最後に何かを受信した時刻（pongを含む）
+        self.last_active = now  # 最後にメッセージを受信した時刻
+        self.pinged_at = 0.0
+
+    async def receive_json(self) -> Dict[str, Any]:
+        data = await self.websocket.receive_json()
+        self.last_received = time.monotonic()
+        self.pinged_at = 0.0
+        if data.get("type") not in ("ping", "pong"):
+            self.last_active = self.last_received
+        return data
+
+    async def send_json(self, message: Dict[str, Any]):
+        """送信待ちに入れる。上限に達している場合は空くまで待つ"""
+        while len(self.queue) >= WS_SEND_QUEUE_SIZE and not self.closed:
+            if self.space is None:
+                self.space = asyncio.get_running_loop().create_future()
+            await self.space
+        if self.closed:
+            raise ConnectionClosed(f"connection {self.id} is closed")
+        self._enqueue(message)
+
+    def send_nowait(self, message: Dict[str, Any]) -> bool:
+        """送信待ちに入れる。上限に達している（受信が遅い）場合は入れずにFalse"""
+        if self.closed or len(self.queue) >= WS_SEND_QUEUE_SIZE:
+            return False
+        self._enqueue(message)
+        return True
+
+    async def drain(self, timeout: float):
+        """送信待ちがなくなるまで待つ（最大timeout秒。閉じる前に最後のフレームを届けるため）"""
+        if self.writer is not None:
+            await asyncio.wait([self.writer], timeout=timeout)
+
+    def _enqueue(self, message: Dict[str, Any]):
+        self.queue.append(message)
+        if self.writer is None:
+            self.writer = asyncio.create_task(self._drain())
+
+    async def _drain(self):
+        try:
+            while self.queue:
+                message = self.queue.popleft()
+                self._wake_senders()
+                await self.websocket.send_json(message)
+        except Exception as e:
+            logger.info(f"WebSocket connection {self.id} send failed: {e}")
+            self.closed = True
+            self.queue.clear()
+            self._wake_senders()
+        finally:
+            self.writer = None
+
+    def _wake_senders(self):
+        if self.space is not None:
+            if not self.space.done():
+                self.space.set_result(None)
+            self.space = None
+
+    def dispatch(self, request_id: str, frames: AsyncIterator[Dict[str, Any]]) -> bool:
+        """framesを別タスクで送信する。同時処理数の上限に達している場合はFalse"""
+        if self.tasks is None:
+            self.tasks = set()
+        if len(self.tasks) >= WS_MAX_CONCURRENCY:
+            return False
+        task = asyncio.create_task(self._relay(request_id, frames))
+        self.tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return True
+
+    def _task_done(self, task: asyncio.Task):
+        if self.tasks is not None:
+            self.tasks.discard(task)
+            if not self.tasks:
+                self.tasks = None
+
+    async def reject(self, request_id: str):
+        await self.send_json({
+            "type": "error",
+            "request_id": request_id,
+            "content": "同時に処理できるメッセージ数の上限に達しました。応答を待ってから送信してください"
+        })
+
+    async def _relay(self, request_id: str, frames: AsyncIterator[Dict[str, Any]]):
+        try:
+            async for frame in frames:
+                await self.send_json({**frame, "request_id": request_id})
+        except asyncio.CancelledError:
+            raise
+        except ConnectionClosed:
+            pass
+        except Exception as e:
+            logger.warning(f"WebSocket connection {self.id} request {request_id} failed: {e}")
+        finally:
+            # 途中で終わった場合も上流へのリクエストを確実に閉じる
+            aclose = getattr(frames, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    async def close(self):
+        """処理中のメッセージを中止し、送信待ちを破棄する"""
+        self.closed = True
+        self.queue.clear()
+        self._wake_senders()
+        tasks = list(self.tasks or ())
+        if self.writer is not None:
+            tasks.append(self.writer)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def approx_size(self) -> int:
+        """この接続が保持しているメモリのおおよそのバイト数（WebSocketオブジェクトを含む）"""
+        size = sys.getsizeof(self) + sys.getsizeof(self.queue)
+        size += sys.getsizeof(self.websocket) + sys.getsizeof(getattr(self.websocket, "__dict__", {}))
+        size += sum(sys.getsizeof(message) for message in self.queue)
+        if self.tasks is not None:
+            size += sys.getsizeof(self.tasks)
+        return size
+
+class ConnectionRegistry:
+    def __init__(self):
+        self._connections: Dict[int, Connection] = {}
+        self._by_user: Dict[str, Dict[int, Connection]] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+        self.evicted = {"pong_timeout": 0, "idle": 0, "slow_consumer": 0}
+
+    def register(self, websocket: WebSocket, user_id: Optional[str] = None, endpoint: str = "") -> Connection:
+        """受け付け済みのWebSocketを登録する"""
+        connection = Connection(websocket, user_id, endpoint)
+        self._connections[connection.id] = connection
+        if user_id is not None:
+            self._by_user.setdefault(user_id, {})[connection.id] = connection
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep())
+        return connection
+
+    async def unregister(self, connection: Connection):
+        """登録を解除し、処理中のメッセージを中止する（何度呼んでもよい）"""
+        self._connections.pop(connection.id, None)
+        connections = self._by_user.get(connection.user_id)
+        if connections is not None:
+            connections.pop(connection.id, None)
+            if not connections:
+                del self._by_user[connection.user_id]
+        await connection.close()
+
+    def for_user(self, user_id: str):
+        return list(self._by_user.get(user_id, {}).values())
+
+    def has_users(self) -> bool:
+        """利用者ID付きの接続（/ws/{user_id}）があるか"""
+        return bool(self._by_user)
+
+    def send_to_user(self, user_id: str, message: Dict[str, Any]) -> int:
+        """利用者のすべての接続に送信し、送信待ちに入れた接続数を返す（受信が遅い接続は切断する）"""
+        sent = 0
+        for connection in self.for_user(user_id):
+            if connection.send_nowait(message):
+                sent += 1
+            elif not connection.closed:
+                self._evict(connection, "slow_consumer", 1013)
+        return sent
+
+    def _evict(self, connection: Connection, reason: str, code: int = 1001):
+        self.evicted[reason] += 1
+        logger.info(f"Evicting WebSocket connection {connection.id} ({reason})")
+        connection.closed = True
+        asyncio.create_task(self._close(connection, code))
+
+    async def _close(self, connection: Connection, code: int):
+        try:
+            await asyncio.wait_for(connection.websocket.close(code=code), timeout=5)
+        except Exception:
+            pass
+        # 受信ループ側でも解除するが、半開きの接続では受信が終わらないことがあるためここでも解除する
+        await self.unregister(connection)
+
+    async def _sweep(self):
+        while self._connections:
+            await asyncio.sleep(min(WS_HEARTBEAT_INTERVAL, WS_PONG_TIMEOUT))
+            now = time.monotonic()
+            for connection in list(self._connections.values()):
+                if connection.closed:
+                    continue
+                if connection.pinged_at and now - connection.pinged_at > WS_PONG_TIMEOUT:
+                    self._evict(connection, "pong_timeout")
+                elif now - connection.last_active > WS_IDLE_TIMEOUT and not connection.tasks:
+                    self._evict(connection, "idle")
+                elif not connection.pinged_at and now - connection.last_received > WS_HEARTBEAT_INTERVAL:
+                    if connection.send_nowait({"type": "ping"}):
+                        connection.pinged_at = now
+                    else:
+                        self._evict(connection, "slow_consumer", 1013)
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+        for connection in list(self._connections.values()):
+            await self.unregister(connection)
+
+    def stats(self) -> Dict[str, Any]:
+        connections = list(self._connections.values())
+        total = sum(c.approx_size() for c in connections)
+        return {
+            "connections": len(connections),
+            "users": len(self._by_user),
+            "busy_connections": sum(1 for c in connections if c.tasks),
+            "queued_frames": sum(len(c.queue) for c in connections),
+            "approx_bytes": total,
+            "approx_bytes_per_connection": total / len(connections) if connections else 0,
+            "evicted": dict(self.evicted),
+        }
+
+connections = ConnectionRegistry()
+
+def _count_by_endpoint() -> Dict[tuple, int]:
+    counts: Dict[tuple, int] = {}
+    for connection in connections._connections.values():
+        key = (connection.endpoint,)
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+websocket_connections_active.set_function(_count_by_endpoint)
@@ -0,0 +1,79 @@
+"""会話IDなし（初回）の質問に対するDify応答のキャッシュ
+
+キーは (ボットモード, 正規化した質問)。TTLと最大件数（LRU）で破棄する。
+Difyの会話IDは利用者ごとに異なるため、キャッシュには保存しない。
+"""
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+import copy
+import re
+import time
+import unicodedata
+from ...config import DIFY_CACHE_DISABLED_BOTS, DIFY_CACHE_MAX_ENTRIES, DIFY_CACHE_TTL
+
+# 利用者・会話ごとに異なるためキャッシュしない項目
+_PER_REQUEST_FIELDS = ("conversation_id", "message_id", "id", "task_id")
+
+def strip_per_request_fields(response: Dict[str, Any]) -> Dict[str, Any]:
+    """他の利用者と共有する応答から会話IDなどを除く"""
+    return {k: v for k, v in response.items() if k not in _PER_REQUEST_FIELDS}
+
+def normalize_query(query: str) -> str:
+    """全角・半角、大文字・小文字、空白の違いを吸収する"""
+    query = unicodedata.normalize("NFKC", query).casefold()
+    return re.sub(r"\s+", " ", query).strip()
+
+class AnswerCache:
+    def __init__(
+        self,
+        max_entries: int = DIFY_CACHE_MAX_ENTRIES,
+        ttl: float = DIFY_CACHE_TTL,
+        disabled_modes=DIFY_CACHE_DISABLED_BOTS
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disabled_modes = set(disabled_modes)
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def enabled_for(self, mode: str) -> bool:
+        return self.max_entries > 0 and self.ttl > 0 and mode not in self.disabled_modes
+
+    def get(self, mode: str, query: str) -> Optional[Dict[str, Any]]:
+        key = (mode, normalize_query(query))
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+                self.evictions += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return copy.deepcopy(entry[1])
+
+    def set(self, mode: str, query: str, response: Dict[str, Any]):
+        key = (mode, normalize_query(query))
+        value = strip_per_request_fields(response)
+        self._entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(value))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "disabled_bots": sorted(self.disabled_modes),
+        }
+
+answer_cache = AnswerCache()
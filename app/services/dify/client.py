@@ -1,7 +1,17 @@
-from typing import Optional, Dict, Any
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, AsyncIterator
 from pydantic import BaseModel
-from ...config import DIFY_API_KEYS
+from ...config import DIFY_API_KEYS, DIFY_BASE_URL
+from ..http_client import http_clients
+from .cache import answer_cache, normalize_query, strip_per_request_fields
+from .singleflight import single_flight
+from .limiter import bulkheads
+from .resilience import RETRY_ATTEMPTS, RETRYABLE_STATUS_CODES, backoff_delay, circuit_breakers
+from ..metrics import dify_request_duration_seconds, dify_responses_total
+import asyncio
 import httpx
+import json
+import time
 from fastapi import HTTPException
 
 class DifyBot(BaseModel):
@@ -12,47 +22,287 @@ class DifyBot(BaseModel):
 
 class DifyClient:
     def __init__(self, mode: str = 'default'):
+        self.mode = mode
         self.api_key = self._get_api_key(mode)
-        self.base_url = "https://api.dify.ai/v1"
-    
+        self.base_url = DIFY_BASE_URL
+
+    def _get_api_key(self, mode: str) -> str:
+        """モードに対応するAPIキーを取得"""
+        if mode not in DIFY_API_KEYS:
+            raise HTTPException(status_code=400, detail=f"不明なボットモードです: {mode}")
+        return DIFY_API_KEYS[mode]
+
+    def _client(self) -> httpx.AsyncClient:
+        """ボットモードごとの共有接続プールを使用"""
+        return http_clients.get(f"dify:{self.mode}")
+
+    def _headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def _payload(
+        self,
+        query: str,
+        conversation_id: Optional[str],
+        user: str,
+        response_mode: str
+    ) -> Dict[str, Any]:
+        return {
+            "inputs": {},
+            "query": query,
+            "response_mode": response_mode,
+            "conversation_id": conversation_id or "",
+            "user": user
+        }
+
     async def send_message(
-        self, 
-        query: str, 
-        conversation_id: Optional[str] = None
+        self,
+        query: str,
+        conversation_id: Optional[str] = None,
+        user: str = "test_user"
+    ) -> Dict[str, Any]:
+        # 会話IDなしの質問はキャッシュを確認
+        cacheable = not conversation_id and answer_cache.enabled_for(self.mode)
+        if cacheable:
+            cached = answer_cache.get(self.mode, query)
+            if cached is not None:
+                return cached
+
+        if conversation_id:
+            return await self._send_blocking(query, conversation_id, user)
+
+        # 会話IDなしの同じ質問が実行中であれば、その結果を共有する
+        leader = False
+
+        def call():
+            nonlocal leader
+            leader = True
+            return self._send_blocking(query, conversation_id, user)
+
+        response = await single_flight.do(("blocking", self.mode, normalize_query(query)), call)
+        if cacheable and response.get("answer"):
+            answer_cache.set(self.mode, query, response)
+        # Difyの会話は最初に実行したリクエストのものなので、共有した側には返さない
+        return dict(response) if leader else strip_per_request_fields(response)
+
+    async def _send_blocking(
+        self,
+        query: str,
+        conversation_id: Optional[str],
+        user: str
     ) -> Dict[str, Any]:
+        request = self._client().build_request(
+            "POST",
+            f"{self.base_url}/chat-messages",
+            headers=self._headers(),
+            json=self._payload(query, conversation_id, user, "blocking"),
+            timeout=30.0  # タイムアウトを30秒に設定
+        )
+        async with self._upstream_slot():
+            response = await self._send(request)
+            return response.json()
+
+    @asynccontextmanager
+    async def _upstream_slot(self):
+        """上流を呼び出す枠を確保する
+
+        上流が不調な間（サーキットブレーカー作動中）は待ち行列に入らずすぐに503を返し、
+        それ以外はボットモードごとの同時実行数の上限まで待機する。
+        """
+        breaker = circuit_breakers.get(self.mode)
+        probe = breaker.before_call()
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/chat-messages",
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "inputs": {},
-                        "query": query,
-                        "response_mode": "blocking",
-                        "conversation_id": conversation_id or "",
-                        "user": "test_user"
-                    },
-                    timeout=30.0  # タイムアウトを30秒に設定
+            async with bulkheads.get(self.mode).acquire():
+                yield
+        finally:
+            if probe:
+                breaker.release_probe()
+
+    async def _send(self, request: httpx.Request, stream: bool = False) -> httpx.Response:
+        """一時的なエラーを再試行しながらリクエストを送信し、結果をサーキットブレーカーに記録
+
+        ステータス200のレスポンスのみ返す（stream=Trueの場合、呼び出し側でacloseする）。
+        """
+        breaker = circuit_breakers.get(self.mode)
+        attempt = 0
+        while True:
+            attempt += 1
+            retry_after = None
+            started = time.perf_counter()
+            try:
+                response = await self._client().send(request, stream=stream)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                self._observe(started, stream, "timeout" if isinstance(e, httpx.ConnectTimeout) else "error")
+                # 送信前のエラーなので再試行しても重複しない
+                error = HTTPException(
+                    status_code=504 if isinstance(e, httpx.ConnectTimeout) else 500,
+                    detail=f"Dify APIリクエストエラー: {str(e)}"
+                )
+            except httpx.TimeoutException:
+                self._observe(started, stream, "timeout")
+                breaker.record_failure()
+                raise HTTPException(
+                    status_code=504,
+                    detail="Dify APIがタイムアウトしました"
+                )
+            except httpx.RequestError as e:
+                self._observe(started, stream, "error")
+                breaker.record_failure()
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Dify APIリクエストエラー: {str(e)}"
                 )
-                
-                if response.status_code != 200:
-                    raise HTTPException(
-                        status_code=response.status_code,
-                        detail=f"Dify API error: {response.text}"
-                    )
-                    
-                return response.json()
-                
-        except httpx.TimeoutException:
-            raise HTTPException(
-                status_code=504,
-                detail="Dify APIがタイムアウトしました"
-            )
-        except httpx.RequestError as e:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Dify APIリクエストエラー: {str(e)}"
-            )
\ No newline at end of file
+            else:
+                self._observe(started, stream, str(response.status_code))
+                if response.status_code == 200:
+                    breaker.record_success()
+                    return response
+
+                body = await response.aread()
+                await response.aclose()
+                error = HTTPException(
+                    status_code=response.status_code,
+                    detail=f"Dify API error: {body.decode(errors='replace')}"
+                )
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    # 4xxはリクエスト側の問題なので上流は正常とみなす
+                    breaker.record_success()
+                    raise error
+                retry_after = response.headers.get("Retry-After")
+
+            if attempt >= RETRY_ATTEMPTS:
+                if error.status_code != 429:
+                    breaker.record_failure()
+                raise error
+            await asyncio.sleep(backoff_delay(attempt, retry_after))
+
+    def _observe(self, started: float, stream: bool, status: str):
+        """1回の送信の応答時間とステータスをメトリクスに記録"""
+        dify_request_duration_seconds.observe(
+            time.perf_counter() - started,
+            mode=self.mode,
+            response_mode="streaming" if stream else "blocking"
+        )
+        dify_responses_total.inc(mode=self.mode, status=status)
+
+    async def stream_message(
+        self,
+        query: str,
+        conversation_id: Optional[str] = None,
+        user: str = "test_user"
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """streamingモードでDify APIを呼び出し、SSEイベントを届いた順に返す"""
+        cacheable = not conversation_id and answer_cache.enabled_for(self.mode)
+        if cacheable:
+            cached = answer_cache.get(self.mode, query)
+            if cached is not None:
+                # キャッシュした応答を1つのメッセージとして返す
+                yield {"event": "message", "answer": cached.get("answer", "")}
+                yield {"event": "message_end", "metadata": cached.get("metadata", {})}
+                return
+
+        leader = True
+        if conversation_id:
+            events = self._stream(query, conversation_id, user)
+        else:
+            # 会話IDなしの同じ質問が実行中であれば、そのイベントを共有する
+            leader = False
+
+            def call():
+                nonlocal leader
+                leader = True
+                return self._stream(query, conversation_id, user)
+
+            events = single_flight.do_stream(("streaming", self.mode, normalize_query(query)), call)
+
+        answer = []
+        async for event in events:
+            if not leader:
+                event = strip_per_request_fields(event)
+            if cacheable:
+                if is_answer_event(event):
+                    answer.append(event.get("answer", ""))
+                elif event.get("event") == "message_end" and answer:
+                    answer_cache.set(self.mode, query, {
+                        "answer": "".join(answer),
+                        "metadata": event.get("metadata", {})
+                    })
+            yield event
+
+    async def _stream(
+        self,
+        query: str,
+        conversation_id: Optional[str],
+        user: str
+    ) -> AsyncIterator[Dict[str, Any]]:
+        request = self._client().build_request(
+            "POST",
+            f"{self.base_url}/chat-messages",
+            headers=self._headers(),
+            json=self._payload(query, conversation_id, user, "streaming"),
+            # 応答全体ではなくチャンク間の待ち時間に対するタイムアウト
+            timeout=httpx.Timeout(30.0, connect=10.0)
+        )
+        # ストリームが終わるまで枠を使用する（再試行するのはストリームの開始まで）
+        async with self._upstream_slot():
+            response = await self._send(request, stream=True)
+            try:
+                async for event in iter_sse_events(response):
+                    yield event
+            except httpx.TimeoutException:
+                raise HTTPException(
+                    status_code=504,
+                    detail="Dify APIがタイムアウトしました"
+                )
+            except httpx.RequestError as e:
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Dify APIリクエストエラー: {str(e)}"
+                )
+            finally:
+                await response.aclose()
+
+async def iter_sse_events(response: httpx.Response) -> AsyncIterator[Dict[str, Any]]:
+    """DifyのSSEレスポンスを行単位で読み、`data:` のJSONをイベントとして返す"""
+    data_lines = []
+    async for line in response.aiter_lines():
+        if line.startswith("data:"):
+            data_lines.append(line[5:].strip())
+            continue
+        if line or not data_lines:
+            # `event:` 行やコメント行（keep-alive）は無視する
+            continue
+
+        # 空行でイベントが確定する
+        event = _parse_event(data_lines)
+        data_lines = []
+        if event is None:
+            continue
+        yield event
+        if event.get("event") == "message_end":
+            return
+
+    # 末尾に空行がないまま切断された場合
+    event = _parse_event(data_lines)
+    if event is not None:
+        yield event
+
+def _parse_event(data_lines) -> Optional[Dict[str, Any]]:
+    if not data_lines:
+        return None
+    try:
+        event = json.loads("\n".join(data_lines))
+    except ValueError:
+        return None
+    if event.get("event") == "error":
+        raise HTTPException(
+            status_code=event.get("status") or 502,
+            detail=f"Dify API error: {event.get('message', '')}"
+        )
+    return event
+
+def is_answer_event(event: Dict[str, Any]) -> bool:
+    """回答テキストの断片を含むイベントかどうか"""
+    return event.get("event") in ("message", "agent_message")
@@ -0,0 +1,90 @@
+"""ボットモードごとのDify同時実行数の制限（バルクヘッド）
+
+上限を超えたリクエストは待ち行列で待機する。待ち行列が満杯、または待ち時間が
+上限を超えた場合は、すぐに429（Retry-After付き）を返す。
+"""
+from contextlib import asynccontextmanager
+from typing import Dict
+import asyncio
+import math
+from fastapi import HTTPException
+from ...config import get_dify_limit_settings
+from ..metrics import dify_requests_in_flight, dify_requests_waiting
+
+class Bulkhead:
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _overloaded(self, detail: str) -> HTTPException:
+        return HTTPException(
+            status_code=429,
+            detail=detail,
+            headers={"Retry-After": str(max(1, math.ceil(self.queue_timeout)))}
+        )
+
+    @asynccontextmanager
+    async def acquire(self):
+        if self._semaphore.locked():
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise self._overloaded(f"{self.name} は混み合っています。しばらくしてから再試行してください")
+
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.timed_out += 1
+                raise self._overloaded(f"{self.name} の待ち時間が上限を超えました")
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+class BulkheadRegistry:
+    def __init__(self):
+        self._bulkheads: Dict[str, Bulkhead] = {}
+
+    def get(self, mode: str) -> Bulkhead:
+        bulkhead = self._bulkheads.get(mode)
+        if bulkhead is None:
+            bulkhead = Bulkhead(f"dify:{mode}", **get_dify_limit_settings(mode))
+            self._bulkheads[mode] = bulkhead
+        return bulkhead
+
+    def stats(self) -> Dict[str, dict]:
+        return {mode: bulkhead.stats() for mode, bulkhead in self._bulkheads.items()}
+
+bulkheads = BulkheadRegistry()
+
+dify_requests_in_flight.set_function(
+    lambda: {(mode,): b.active for mode, b in bulkheads._bulkheads.items()}
+)
+dify_requests_waiting.set_function(
+    lambda: {(mode,): b.waiting for mode, b in bulkheads._bulkheads.items()}
+)
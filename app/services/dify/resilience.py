@@ -0,0 +1,126 @@
+"""Dify APIの再試行とサーキットブレーカー
+
+- 一時的なエラー（接続エラー・429・5xx）はジッター付きの指数バックオフで再試行する
+- ボットモードごとに連続失敗を数え、しきい値を超えたら一定時間すぐに503を返す（open）
+- 一定時間後は1件だけ試行し（half-open）、成功すれば復帰する
+"""
+from typing import Dict, Optional
+import math
+import random
+import time
+from fastapi import HTTPException
+from ...config import (
+    DIFY_BREAKER_FAILURE_THRESHOLD,
+    DIFY_BREAKER_RECOVERY_TIMEOUT,
+    DIFY_RETRY_ATTEMPTS,
+    DIFY_RETRY_BASE_DELAY,
+    DIFY_RETRY_MAX_DELAY,
+)
+from ..metrics import dify_circuit_open
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRY_ATTEMPTS = max(1, DIFY_RETRY_ATTEMPTS)
+
+def backoff_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """attempt回目の失敗後の待ち時間（full jitter）。Retry-Afterがあればそれを優先"""
+    if retry_after:
+        try:
+            return min(float(retry_after), DIFY_RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    ceiling = min(DIFY_RETRY_MAX_DELAY, DIFY_RETRY_BASE_DELAY * (2 ** (attempt - 1)))
+    return random.uniform(0, ceiling)
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = DIFY_BREAKER_FAILURE_THRESHOLD,
+        recovery_timeout: float = DIFY_BREAKER_RECOVERY_TIMEOUT
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.short_circuited = 0
+
+    def before_call(self) -> bool:
+        """呼び出し前に確認し、openの間は503を返す（half-openの試行を受け持つ場合はTrue）"""
+        if self.state == self.CLOSED:
+            return False
+        if self.state == self.OPEN:
+            remaining = self.opened_at + self.recovery_timeout - time.monotonic()
+            if remaining > 0:
+                self._reject(remaining)
+            self.state = self.HALF_OPEN
+            self.probing = False
+        if self.probing:
+            # half-openでは1件だけ試行する
+            self._reject(self.recovery_timeout)
+        self.probing = True
+        return True
+
+    def _reject(self, retry_after: float):
+        self.short_circuited += 1
+        raise HTTPException(
+            status_code=503,
+            detail=f"{self.name} は現在利用できません（サーキットブレーカー作動中）",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def release_probe(self):
+        """試行が結果を記録せずに終わった場合（キャンセルなど）に次の試行を許可する
+
+        before_call() がTrueを返した呼び出しだけが呼ぶ（closedの間に始まった呼び出しが
+        half-openの試行中に終わっても、試行中の印を消さないように）。
+        """
+        self.probing = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "short_circuited": self.short_circuited,
+        }
+
+class CircuitBreakerRegistry:
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, mode: str) -> CircuitBreaker:
+        breaker = self._breakers.get(mode)
+        if breaker is None:
+            breaker = CircuitBreaker(f"dify:{mode}")
+            self._breakers[mode] = breaker
+        return breaker
+
+    def stats(self) -> Dict[str, dict]:
+        return {mode: breaker.stats() for mode, breaker in self._breakers.items()}
+
+circuit_breakers = CircuitBreakerRegistry()
+
+dify_circuit_open.set_function(
+    lambda: {
+        (mode,): int(breaker.state != CircuitBreaker.CLOSED)
+        for mode, breaker in circuit_breakers._breakers.items()
+    }
+)
@@ -0,0 +1,113 @@
+"""同一リクエストの同時実行をまとめる（single-flight）
+
+同じキーの呼び出しが実行中であれば、新たに上流へリクエストせず、実行中の結果を共有する。
+- 例外はすべての待機者に同じものが伝わる
+- 待機者の一部がキャンセルされても共有の呼び出しは続く。全員がいなくなった場合のみ中止する
+"""
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+import asyncio
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+class _StreamCall:
+    __slots__ = ("task", "waiters", "events", "done", "error", "changed")
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        self.events: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self._streams: Dict[Hashable, _StreamCall] = {}
+        self.shared = 0  # 上流へのリクエストを省略できた回数
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """fn() の結果を返す。同じキーが実行中であればその結果を待つ"""
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(self._calls, key, call))
+        else:
+            self.shared += 1
+
+        call.waiters += 1
+        try:
+            # 待機者がキャンセルされても共有のタスク自体はキャンセルしない
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if call.waiters == 1 and not call.task.done():
+                # 中止する呼び出しに後から合流しないよう、キャンセルと同時にキーを外す
+                self._forget(self._calls, key, call)
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    async def do_stream(
+        self,
+        key: Hashable,
+        fn: Callable[[], AsyncIterator[Any]]
+    ) -> AsyncIterator[Any]:
+        """fn() のイベントを返す。同じキーが実行中であれば、最初から同じイベントを受け取る"""
+        call = self._streams.get(key)
+        if call is None:
+            call = _StreamCall()
+            self._streams[key] = call
+            call.task = asyncio.ensure_future(self._pump(call, fn))
+            call.task.add_done_callback(lambda _: self._forget(self._streams, key, call))
+        else:
+            self.shared += 1
+
+        call.waiters += 1
+        index = 0
+        try:
+            while True:
+                while index < len(call.events):
+                    yield call.events[index]
+                    index += 1
+                if call.done:
+                    if call.error is not None:
+                        raise call.error
+                    return
+                call.changed.clear()
+                await call.changed.wait()
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # 受信者がいなくなった場合は上流へのリクエストを中止する
+                # （中止する呼び出しに後から合流しないよう、キャンセルと同時にキーを外す）
+                self._forget(self._streams, key, call)
+                call.task.cancel()
+
+    @staticmethod
+    async def _pump(call: _StreamCall, fn: Callable[[], AsyncIterator[Any]]):
+        try:
+            async for event in fn():
+                call.events.append(event)
+                call.changed.set()
+        except asyncio.CancelledError:
+            call.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            call.error = e
+        finally:
+            call.done = True
+            call.changed.set()
+
+    @staticmethod
+    def _forget(calls: Dict[Hashable, Any], key: Hashable, call: Any):
+        if calls.get(key) is call:
+            del calls[key]
+
+single_flight = SingleFlight()
@@ -0,0 +1,110 @@
+"""DifyのSSEイベントをWebSocketのフレーム（start / delta / end）に変換する
+
+- start: 受け付けた時点ですぐに送る
+- delta: 回答の断片。最初の断片はすぐに送り、以降は WS_STREAM_FLUSH_MS ミリ秒ごと、または
+  WS_STREAM_FLUSH_CHARS 文字たまったらまとめて送る
+- end: 全文・使用量（Difyのmessage_endのusage）・会話ID
+
+上流の読み取りは別タスクで行い、先読みは WS_STREAM_BUFFER_EVENTS 件まで。クライアントの
+受信が遅く送信が詰まっている間は、たまった断片を次のフレームにまとめ、先読みが上限に
+達したら上流の読み取りも止める（背圧）。
+"""
+from typing import Any, AsyncIterator, Dict, List, Optional
+import asyncio
+from ...config import WS_STREAM_BUFFER_EVENTS, WS_STREAM_FLUSH_CHARS, WS_STREAM_FLUSH_INTERVAL
+from .client import is_answer_event
+
+_DONE = object()
+
+async def stream_frames(
+    events: AsyncIterator[Dict[str, Any]],
+    flush_interval: float = WS_STREAM_FLUSH_INTERVAL,
+    flush_chars: int = WS_STREAM_FLUSH_CHARS,
+    buffer_events: int = WS_STREAM_BUFFER_EVENTS
+) -> AsyncIterator[Dict[str, Any]]:
+    yield {"type": "start"}
+
+    queue: asyncio.Queue = asyncio.Queue(maxsize=buffer_events)
+    producer = asyncio.create_task(_pump(events, queue))
+    loop = asyncio.get_running_loop()
+
+    answer: List[str] = []
+    pending: List[str] = []
+    deadline: Optional[float] = None
+    first = True
+    held = None  # まとめる際に先に取り出した、断片以外の要素
+    pending_chars = 0
+    conversation_id = None
+    usage: Dict[str, Any] = {}
+
+    def take(event: Dict[str, Any]):
+        nonlocal pending_chars, conversation_id, usage
+        conversation_id = event.get("conversation_id") or conversation_id
+        if is_answer_event(event) and event.get("answer"):
+            pending.append(event["answer"])
+            pending_chars += len(event["answer"])
+        elif event.get("event") == "message_end":
+            usage = event.get("metadata", {}).get("usage", {})
+
+    try:
+        while True:
+            if held is not None:
+                item, held = held, None
+            else:
+                timeout = None if deadline is None else max(0.0, deadline - loop.time())
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    item = None
+            if isinstance(item, BaseException):
+                raise item
+
+            if item is not None and item is not _DONE:
+                take(item)
+                # 送信を待っている間に届いた断片もまとめる
+                while pending_chars < flush_chars and not queue.empty():
+                    queued = queue.get_nowait()
+                    if queued is _DONE or isinstance(queued, BaseException) or not is_answer_event(queued):
+                        held = queued
+                        break
+                    take(queued)
+                if pending and deadline is None:
+                    deadline = loop.time() + flush_interval
+
+            done = item is _DONE
+            due = deadline is not None and loop.time() >= deadline
+            if pending and (first or done or due or pending_chars >= flush_chars):
+                text = "".join(pending)
+                answer.append(text)
+                pending.clear()
+                pending_chars = 0
+                deadline = None
+                first = False
+                yield {"type": "delta", "content": text, "conversation_id": conversation_id}
+            if done:
+                break
+
+        yield {
+            "type": "end",
+            "content": "".join(answer),
+            "conversation_id": conversation_id,
+            "usage": usage
+        }
+    finally:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+
+async def _pump(events: AsyncIterator[Dict[str, Any]], queue: asyncio.Queue):
+    try:
+        async for event in events:
+            await queue.put(event)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        await queue.put(e)
+        return
+    finally:
+        aclose = getattr(events, "aclose", None)
+        if aclose is not None:
+            await aclose()
+    await queue.put(_DONE)
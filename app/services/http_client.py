@@ -0,0 +1,34 @@
+from typing import Dict
+import httpx
+from ..config import get_http_pool_settings
+
+class HTTPClientRegistry:
+    """上流APIごとにkeep-alive接続プールを持つhttpx.AsyncClientを共有する"""
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        """プール名（例: "dify:default", "mistral"）に対応するクライアントを取得"""
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            settings = get_http_pool_settings(name)
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=settings['max_connections'],
+                    max_keepalive_connections=settings['max_keepalive_connections'],
+                    keepalive_expiry=settings['keepalive_expiry'],
+                ),
+                timeout=30.0
+            )
+            self._clients[name] = client
+        return client
+
+    async def aclose(self):
+        """アプリ終了時にすべての接続プールを閉じる"""
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+http_clients = HTTPClientRegistry()
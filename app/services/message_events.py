@@ -0,0 +1,43 @@
+"""会話に新しいメッセージが保存されたことの通知（ロングポーリング用）
+
+書き込み側はコミット後に notify() を呼び、待っているリクエストを起こす。
+通知はこのプロセス内だけで届く（他のワーカーで保存されたメッセージは、待ち時間が
+過ぎた後の再読み込みで返す）。
+"""
+from typing import Dict, Set
+import asyncio
+
+class MessageNotifier:
+    def __init__(self):
+        self._waiters: Dict[int, Set[asyncio.Future]] = {}
+
+    def subscribe(self, conversation_id: int) -> asyncio.Future:
+        """通知を待つFutureを登録する（新着の確認より前に登録し、取りこぼしを防ぐ）"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(conversation_id, set()).add(future)
+        return future
+
+    def unsubscribe(self, conversation_id: int, future: asyncio.Future):
+        waiters = self._waiters.get(conversation_id)
+        if waiters is not None:
+            waiters.discard(future)
+            if not waiters:
+                del self._waiters[conversation_id]
+
+    async def wait(self, conversation_id: int, future: asyncio.Future, timeout: float) -> bool:
+        """通知があればTrue、timeout秒過ぎればFalse（どちらの場合も登録を解除する）"""
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.unsubscribe(conversation_id, future)
+
+    def notify(self, *conversation_ids: int):
+        for conversation_id in conversation_ids:
+            for future in self._waiters.pop(conversation_id, ()):
+                if not future.done():
+                    future.set_result(None)
+
+message_notifier = MessageNotifier()
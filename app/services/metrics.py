@@ -0,0 +1,276 @@
+"""プロセス内のメトリクス（Prometheusのテキスト形式で /metrics から公開）
+
+外部ライブラリを使わず、カウンター・ゲージ・ヒストグラムを最小限で実装する。
+イベントループ上からのみ更新する前提でロックは使わない（スロークエリの件数は
+同期エンジンのスレッドからも加算するが、まれな取りこぼしは許容する）。
+"""
+from typing import Callable, Dict, Iterable, List, Tuple
+import bisect
+import math
+import time
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """(名前の接尾辞, ラベル文字列, 値) の一覧"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        return [
+            ("", _format_labels(self.labelnames, key), value)
+            for key, value in sorted(self._values.items())
+        ]
+
+class Gauge(_Metric):
+    """値を直接増減するか、収集時に関数から値を取得する"""
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._functions: List[Callable[[], Dict[LabelValues, float]]] = []
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, fn: Callable[[], Dict[LabelValues, float]]):
+        """fn() は {ラベル値のタプル: 値} を返す"""
+        self._functions.append(fn)
+
+    def samples(self):
+        values = dict(self._values)
+        for fn in self._functions:
+            values.update(fn())
+        return [
+            ("", _format_labels(self.labelnames, key), value)
+            for key, value in sorted(values.items())
+        ]
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # ラベルごとに [バケットごとの件数..., 合計, 件数]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        row = self._values.get(key)
+        if row is None:
+            row = [0] * (len(self.buckets) + 2)
+            self._values[key] = row
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            row[index] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def samples(self):
+        result = []
+        names = self.labelnames + ("le",)
+        for key, row in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                result.append(("_bucket", _format_labels(names, key + (_format_value(bound),)), cumulative))
+            result.append(("_bucket", _format_labels(names, key + ("+Inf",)), row[-1]))
+            result.append(("_sum", _format_labels(self.labelnames, key), row[-2]))
+            result.append(("_count", _format_labels(self.labelnames, key), row[-1]))
+        return result
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"メトリクスが重複しています: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+registry = MetricsRegistry()
+
+# HTTP
+http_requests_total = registry.counter(
+    "http_requests_total", "HTTPリクエスト数", ("method", "route", "status")
+)
+http_request_duration_seconds = registry.histogram(
+    "http_request_duration_seconds", "HTTPリクエストの処理時間", ("method", "route")
+)
+http_requests_in_flight = registry.gauge(
+    "http_requests_in_flight", "処理中のHTTPリクエスト数", ("method",)
+)
+http_request_db_seconds = registry.histogram(
+    "http_request_db_seconds",
+    "1リクエストあたりのDB時間（グループコミットのライターでの書き込みを除く）",
+    ("method", "route"),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+http_request_db_queries = registry.histogram(
+    "http_request_db_queries",
+    "1リクエストあたりのSQL実行数",
+    ("method", "route"),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100)
+)
+db_slow_queries_total = registry.counter(
+    "db_slow_queries_total", "SQL_SLOW_QUERY_MS 以上かかったSQLの数"
+)
+db_n_plus_one_total = registry.counter(
+    "db_n_plus_one_total", "同じSQLを繰り返し実行した（N+1の可能性がある）リクエスト内のSQLの種類数", ("route",)
+)
+
+# Dify
+dify_request_duration_seconds = registry.histogram(
+    "dify_request_duration_seconds",
+    "Dify APIの応答時間（streamingはヘッダー受信まで、再試行は1回ずつ記録）",
+    ("mode", "response_mode")
+)
+dify_responses_total = registry.counter(
+    "dify_responses_total", "Dify APIの応答数（statusはHTTPステータスまたはtimeout/error）", ("mode", "status")
+)
+dify_requests_in_flight = registry.gauge(
+    "dify_requests_in_flight", "実行中のDify APIリクエスト数", ("mode",)
+)
+dify_requests_waiting = registry.gauge(
+    "dify_requests_waiting", "同時実行数の上限で待機中のDify APIリクエスト数", ("mode",)
+)
+dify_circuit_open = registry.gauge(
+    "dify_circuit_open", "サーキットブレーカーが作動中（open/half_open）なら1", ("mode",)
+)
+
+# トークン
+tokens_consumed_total = registry.counter(
+    "tokens_consumed_total", "消費したトークン数（input: /chat, response: /chat/response）", ("kind",)
+)
+quota_rejections_total = registry.counter(
+    "quota_rejections_total", "/chat でトークン不足により拒否したリクエスト数"
+)
+tokens_rejected_total = registry.counter(
+    "tokens_rejected_total", "/chat でトークン不足により拒否したリクエストの必要トークン数"
+)
+
+# WebSocket
+websocket_connections_active = registry.gauge(
+    "websocket_connections_active", "接続中のWebSocket数", ("endpoint",)
+)
+
+class MetricsMiddleware:
+    """HTTPリクエストの件数・処理時間・処理中の数を記録するASGIミドルウェア"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc(method=method)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_requests_in_flight.dec(method=method)
+            route = route_label(scope)
+            http_requests_total.inc(method=method, route=route, status=str(status))
+            http_request_duration_seconds.observe(elapsed, method=method, route=route)
+
+def route_label(scope) -> str:
+    """パスのテンプレート（/conversations/{user_id} など）を返し、ラベルの種類が増えすぎないようにする"""
+    route = scope.get("route")
+    if route is not None:
+        return getattr(route, "path", "other")
+    # マウントされたアプリ（/static）ではpathからマウント先の部分が除かれ、root_pathに移る
+    if (scope.get("root_path", "") + scope.get("path", "")).startswith("/static/"):
+        return "/static"
+    return "other"
@@ -0,0 +1,220 @@
+"""リクエスト単位のプロファイリング（サンプリング方式）
+
+PROFILING_ENABLED=1 のときだけミドルウェアと管理用エンドポイントを登録する（無効時は何もしない）。
+有効にする場合は PROFILE_ADMIN_TOKEN の設定が必須（未設定なら起動に失敗させる）。
+次のどちらかに当てはまるリクエストをプロファイルする:
+- `X-Profile: 1` ヘッダーと、PROFILE_ADMIN_TOKEN と一致する `X-Admin-Token` ヘッダー付き
+- PROFILE_SAMPLE_RATE（0〜1）の割合でランダムに選ばれた
+
+プロファイル中はバックグラウンドのスレッドが PROFILE_INTERVAL_MS ごとに全スレッドのスタックを採取する。
+イベントループのスレッドのスタックは、実行中のタスクに応じて次のように分類する:
+- request: プロファイル対象のリクエストのタスク
+- task:<名前>: 他のタスク（StreamingResponseの本文やライターなど）
+- event_loop: タスク外（I/O待ちやコールバック）
+他のスレッド（トークン数の計算や同期エンドポイントのスレッドプール）は thread:<名前> とする。
+
+結果は直近 PROFILE_RING_SIZE 件をメモリに保持し、flamegraph.pl や speedscope で読める
+folded形式（`root;frame;frame 件数`）でダウンロードできる。
+"""
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional
+import asyncio
+import hmac
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_HEADER = os.getenv("PROFILE_HEADER", "X-Profile").lower().encode()
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+PROFILE_RING_SIZE = int(os.getenv("PROFILE_RING_SIZE", "50"))
+PROFILE_MAX_CONCURRENT = int(os.getenv("PROFILE_MAX_CONCURRENT", "4"))
+
+if PROFILING_ENABLED and not PROFILE_ADMIN_TOKEN:
+    # 管理用エンドポイントとX-Profileヘッダーを誰でも使えてしまうため
+    raise ValueError("PROFILING_ENABLED=1 の場合は PROFILE_ADMIN_TOKEN を設定してください")
+
+def check_admin_token(token: Optional[str]) -> bool:
+    """管理用トークンの確認（比較にかかる時間から推測されないよう、一定時間で比較する）"""
+    if not token or not PROFILE_ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(token.encode("latin-1", "replace"), PROFILE_ADMIN_TOKEN.encode("latin-1", "replace"))
+
+class Profile:
+    def __init__(self, profile_id: int, method: str, path: str, task: Optional[asyncio.Task]):
+        self.id = profile_id
+        self.method = method
+        self.path = path
+        self.task = task
+        self.loop = task.get_loop() if task is not None else None
+        self.loop_thread = threading.get_ident()
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.duration = 0.0
+        self.status: Optional[int] = None
+        self.samples = 0
+        self.stacks: Counter = Counter()
+
+    def finish(self, status: Optional[int]):
+        self.duration = time.perf_counter() - self._started
+        self.status = status
+        self.task = None  # タスクへの参照を残さない
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "started_at": self.started_at,
+            "duration_ms": self.duration * 1000,
+            "samples": self.samples,
+        }
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+class Profiler:
+    def __init__(
+        self,
+        interval: float = PROFILE_INTERVAL,
+        ring_size: int = PROFILE_RING_SIZE,
+        max_concurrent: int = PROFILE_MAX_CONCURRENT
+    ):
+        self.interval = interval
+        self.max_concurrent = max_concurrent
+        self.profiles: Deque[Profile] = deque(maxlen=ring_size)
+        self._active: List[Profile] = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def should_profile(self, headers: Dict[bytes, bytes]) -> bool:
+        if headers.get(PROFILE_HEADER) == b"1":
+            return check_admin_token(headers.get(b"x-admin-token", b"").decode("latin-1"))
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    def begin(self, method: str, path: str) -> Optional[Profile]:
+        """プロファイルを開始する。同時に実行中のプロファイルが上限に達している場合はNone"""
+        with self._lock:
+            if len(self._active) >= self.max_concurrent:
+                return None
+            profile = Profile(next(self._ids), method, path, asyncio.current_task())
+            self._active.append(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+        return profile
+
+    def end(self, profile: Profile, status: Optional[int]):
+        with self._lock:
+            self._active.remove(profile)
+            profile.finish(status)
+        self.profiles.append(profile)
+
+    def get(self, profile_id: int) -> Optional[Profile]:
+        for profile in self.profiles:
+            if profile.id == profile_id:
+                return profile
+        return None
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                frames = sys._current_frames()
+                for profile in self._active:
+                    self._sample(profile, frames, names, own)
+
+    @staticmethod
+    def _sample(profile: Profile, frames, names: Dict[int, str], own: int):
+        current = _current_task(profile.loop)
+        for ident, frame in frames.items():
+            if ident == own:
+                continue
+            if ident == profile.loop_thread:
+                if current is None:
+                    root = "event_loop"
+                elif current is profile.task:
+                    root = "request"
+                else:
+                    root = f"task:{current.get_name()}"
+            else:
+                root = f"thread:{names.get(ident, ident)}"
+            profile.stacks[_fold(root, frame)] += 1
+        profile.samples += 1
+
+def _current_task(loop: Optional[asyncio.AbstractEventLoop]) -> Optional[asyncio.Task]:
+    """loopで実行中のタスク（別スレッドからの参照なので、まれに1サンプル分ずれることは許容する）
+
+    取得できない場合（Pythonの実装による）はNoneとし、タスク外（event_loop）として集計する。
+    """
+    if loop is None:
+        return None
+    try:
+        return asyncio.current_task(loop)
+    except Exception:
+        return None
+
+def _fold(root: str, frame) -> str:
+    labels = []
+    while frame is not None:
+        code = frame.f_code
+        labels.append(f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    labels.append(root)
+    return ";".join(reversed(labels))
+
+_PATH_PREFIXES = sorted({p for p in sys.path if p and os.path.isdir(p)}, key=len, reverse=True)
+
+def _short_path(filename: str) -> str:
+    for prefix in _PATH_PREFIXES:
+        if filename.startswith(prefix):
+            return filename[len(prefix):].lstrip(os.sep)
+    return filename
+
+profiler = Profiler()
+
+class ProfilingMiddleware:
+    """対象のリクエストをプロファイルし、レスポンスに `X-Profile-Id` を付けるASGIミドルウェア"""
+
+    def __init__(self, app, profiler: Profiler = profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.should_profile(dict(scope["headers"])):
+            await self.app(scope, receive, send)
+            return
+
+        profile = self.profiler.begin(scope["method"], scope["path"])
+        if profile is None:
+            await self.app(scope, receive, send)
+            return
+
+        status = None
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-profile-id", str(profile.id).encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.profiler.end(profile, status)
@@ -0,0 +1,159 @@
+"""トークン残量の確保（reserve）と精算（settle）
+
+残量の確認と減算を1つの条件付きUPDATEで行うため、同じユーザーの同時リクエストでも
+残量を超えて消費されない。精算されないまま TOKEN_RESERVATION_TTL 秒を過ぎた予約
+（応答の取得に失敗した場合など）は、バックグラウンドで取り消して仮押さえ分を返却する。
+"""
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+import asyncio
+import logging
+from sqlalchemy import delete, insert, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..config import TOKEN_RESERVATION_SWEEP_INTERVAL, TOKEN_RESERVATION_TTL
+from ..database import TokenReservation, TokenUsage
+from .. import repository
+from . import versions
+from .writer import writer
+
+logger = logging.getLogger(__name__)
+
+async def _try_reserve(db: AsyncSession, user_id: str, amount: int) -> Optional[int]:
+    result = await db.execute(
+        update(TokenUsage)
+        .where(
+            TokenUsage.user_id == user_id,
+            TokenUsage.remaining_tokens >= amount
+        )
+        .values(
+            remaining_tokens=TokenUsage.remaining_tokens - amount,
+            last_updated=datetime.utcnow()
+        )
+        .returning(TokenUsage.remaining_tokens)
+        .execution_options(synchronize_session=False)
+    )
+    return result.scalar()
+
+async def reserve(
+    db: AsyncSession,
+    user_id: str,
+    amount: int,
+    hold: int = 0
+) -> Optional[Tuple[int, Optional[int]]]:
+    """amountトークンを確保し、(残量, 予約ID) を返す。残量が足りない場合はNone
+
+    holdはamountのうち応答分として仮押さえする量で、settleで実際の消費量との差を精算する。
+    コミットは呼び出し側で行う。
+    """
+    remaining = await _try_reserve(db, user_id, amount)
+    if remaining is None and await repository.get_token_usage(db, user_id) is None:
+        # 新規ユーザーの場合は初期トークンを設定してから再試行
+        await repository.get_or_create_token_usage(db, user_id, commit=False)
+        remaining = await _try_reserve(db, user_id, amount)
+    if remaining is None:
+        return None
+
+    reservation_id = None
+    if hold:
+        result = await db.execute(
+            insert(TokenReservation)
+            .values(user_id=user_id, amount=hold, created_at=datetime.utcnow())
+            .returning(TokenReservation.id)
+        )
+        reservation_id = result.scalar()
+    return remaining, reservation_id
+
+async def settle(
+    db: AsyncSession,
+    user_id: str,
+    actual: int,
+    reservation_id: Optional[int] = None
+) -> Optional[int]:
+    """実際の消費量で精算し、残量を返す（ユーザーが存在しない場合はNone）
+
+    予約分より少なければ差分を返却し、多ければ不足分を追加で消費する。
+    """
+    held = 0
+    if reservation_id is not None:
+        result = await db.execute(
+            delete(TokenReservation)
+            .where(
+                TokenReservation.id == reservation_id,
+                TokenReservation.user_id == user_id
+            )
+            .returning(TokenReservation.amount)
+            .execution_options(synchronize_session=False)
+        )
+        held = result.scalar() or 0  # 精算済み・不明な予約は0として扱う
+
+    result = await db.execute(
+        update(TokenUsage)
+        .where(TokenUsage.user_id == user_id)
+        .values(
+            remaining_tokens=TokenUsage.remaining_tokens + (held - actual),
+            last_updated=datetime.utcnow()
+        )
+        .returning(TokenUsage.remaining_tokens)
+        .execution_options(synchronize_session=False)
+    )
+    remaining = result.scalar()
+    await db.commit()
+    return remaining
+
+async def release_expired(db: AsyncSession, ttl: float = TOKEN_RESERVATION_TTL) -> int:
+    """ttl秒を過ぎても精算されていない予約を取り消して返却し、取り消した件数を返す
+
+    コミットは呼び出し側で行う。
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+    result = await db.execute(
+        delete(TokenReservation)
+        .where(TokenReservation.created_at < cutoff)
+        .returning(TokenReservation.user_id, TokenReservation.amount)
+        .execution_options(synchronize_session=False)
+    )
+    rows = result.all()
+    refunds: Dict[str, int] = {}
+    for user_id, amount in rows:
+        refunds[user_id] = refunds.get(user_id, 0) + amount
+    for user_id, amount in refunds.items():
+        await db.execute(
+            update(TokenUsage)
+            .where(TokenUsage.user_id == user_id)
+            .values(
+                remaining_tokens=TokenUsage.remaining_tokens + amount,
+                last_updated=datetime.utcnow()
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await versions.bump(db, user_id=user_id)
+    return len(rows)
+
+class ReservationSweeper:
+    """期限切れの予約を TOKEN_RESERVATION_SWEEP_INTERVAL 秒ごとに返却する"""
+
+    def __init__(self, interval: float = TOKEN_RESERVATION_SWEEP_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                released = await writer.submit(release_expired)
+                if released:
+                    logger.info(f"Released {released} expired token reservations")
+            except Exception as e:
+                logger.warning(f"Releasing expired token reservations failed: {e}")
+
+reservation_sweeper = ReservationSweeper()
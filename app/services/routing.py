@@ -0,0 +1,123 @@
+"""WebSocketのメッセージ配信（ワーカー間のルーティング）
+
+WS_ROUTING_BACKEND で選択する:
+- local: このプロセスに接続している利用者にのみ配信する（ワーカー1つの場合）
+- sqlite: 共有のSQLiteテーブル（ws_outbox）に書き込み、各ワーカーが WS_OUTBOX_POLL_MS ごとに
+  新しい行を読んで自分に接続している利用者へ配信する。uvicornを複数ワーカーで起動しても、
+  どのワーカーからでも任意の利用者に届く。行は WS_OUTBOX_RETENTION 秒後に削除する。
+  利用者ID付きの接続がないワーカーは読み取りを休み、接続ができたら最新の行から再開する
+  （接続がない間のメッセージは届け先がないため）
+
+配信しているのは会話一覧の変更通知（`{"type": "conversations_changed"}`、app/main.py）。
+"""
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+import asyncio
+import json
+import logging
+import time
+from sqlalchemy import delete, func, select
+from ..config import WS_OUTBOX_POLL_INTERVAL, WS_OUTBOX_RETENTION, WS_ROUTING_BACKEND
+from ..database import AsyncReadSessionLocal, OutboxMessage
+from .connections import ConnectionRegistry, connections
+from .writer import writer
+
+logger = logging.getLogger(__name__)
+
+class LocalBackend:
+    def __init__(self, registry: ConnectionRegistry):
+        self.registry = registry
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, user_id: str, message: Dict[str, Any]):
+        self.registry.send_to_user(user_id, message)
+
+class SQLiteOutboxBackend:
+    PRUNE_INTERVAL = 10.0  # 秒
+
+    def __init__(
+        self,
+        registry: ConnectionRegistry,
+        poll_interval: float = WS_OUTBOX_POLL_INTERVAL,
+        retention: float = WS_OUTBOX_RETENTION,
+        batch_size: int = 500
+    ):
+        self.registry = registry
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.batch_size = batch_size
+        self.last_id = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # 起動前に書き込まれたメッセージは配信しない
+        await self._skip_to_latest()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def publish(self, user_id: str, message: Dict[str, Any]):
+        """コミットされた時点で全ワーカーから見える（このワーカーにも同じ経路で届く）"""
+        await writer.add(OutboxMessage(user_id=user_id, payload=json.dumps(message, ensure_ascii=False)))
+
+    async def _run(self):
+        last_prune = time.monotonic()
+        idle = False
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                if not self.registry.has_users():
+                    idle = True
+                elif idle:
+                    await self._skip_to_latest()
+                    idle = False
+                else:
+                    await self._deliver()
+                if time.monotonic() - last_prune > self.PRUNE_INTERVAL:
+                    last_prune = time.monotonic()
+                    await writer.submit(self._prune)
+            except Exception as e:
+                logger.warning(f"WebSocket outbox polling failed: {e}")
+
+    async def _skip_to_latest(self):
+        async with AsyncReadSessionLocal() as db:
+            self.last_id = await db.scalar(select(func.max(OutboxMessage.id))) or self.last_id
+
+    async def _deliver(self):
+        while True:
+            async with AsyncReadSessionLocal() as db:
+                rows = (await db.execute(
+                    select(OutboxMessage.id, OutboxMessage.user_id, OutboxMessage.payload)
+                    .where(OutboxMessage.id > self.last_id)
+                    .order_by(OutboxMessage.id)
+                    .limit(self.batch_size)
+                )).all()
+            for row_id, user_id, payload in rows:
+                self.last_id = row_id
+                # このワーカーに接続していない利用者の行は読み飛ばす
+                if self.registry.for_user(user_id):
+                    self.registry.send_to_user(user_id, json.loads(payload))
+            if len(rows) < self.batch_size:
+                return
+
+    async def _prune(self, session):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.retention)
+        await session.execute(delete(OutboxMessage).where(OutboxMessage.created_at < cutoff))
+
+def create_backend(name: str = WS_ROUTING_BACKEND, registry: ConnectionRegistry = connections):
+    if name == "local":
+        return LocalBackend(registry)
+    if name == "sqlite":
+        return SQLiteOutboxBackend(registry)
+    raise ValueError(f"不明なWS_ROUTING_BACKENDです: {name}")
+
+routing_backend = create_backend()
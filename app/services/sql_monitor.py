@@ -0,0 +1,127 @@
+"""リクエストごとのSQL実行の計測
+
+SQLAlchemyのエンジンイベントから、リクエストごとに次を集計する:
+- クエリ数・DB時間・コミット数（SQL_DEBUG_HEADERS=1 のときレスポンスヘッダーに付ける）
+- SQL_SLOW_QUERY_MS 以上かかったクエリ（パラメーターは型のみ記録する）
+- 同じSQLが SQL_N_PLUS_ONE_THRESHOLD 回以上実行されたリクエスト（N+1の可能性）
+
+集計はcontextvarで現在のリクエストに紐付ける。非同期エンジンのイベントはSQLAlchemyが
+作るgreenlet内で呼ばれるが、greenletは呼び出し元のcontextを引き継ぐため同じ集計に加算される。
+グループコミットのライターでの書き込みは別タスクで実行されるため含まない。
+"""
+from collections import Counter
+from contextvars import ContextVar
+from typing import Any, Optional
+import logging
+import os
+import re
+import time
+from sqlalchemy import event
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_SECONDS = float(os.getenv("SQL_SLOW_QUERY_MS", "100")) / 1000
+N_PLUS_ONE_THRESHOLD = int(os.getenv("SQL_N_PLUS_ONE_THRESHOLD", "5"))
+DEBUG_HEADERS = os.getenv("SQL_DEBUG_HEADERS", "0") == "1"
+
+class QueryStats:
+    __slots__ = ("queries", "db_time", "commits", "statements")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.commits = 0
+        self.statements: Counter = Counter()
+
+    def repeated(self):
+        """N+1の可能性がある（同じSQLが何度も実行された）ものを返す"""
+        return [
+            (statement, count)
+            for statement, count in self.statements.most_common()
+            if count >= N_PLUS_ONE_THRESHOLD
+        ]
+
+current_stats: ContextVar[Optional[QueryStats]] = ContextVar("current_query_stats", default=None)
+
+def _normalize(statement: str) -> str:
+    return re.sub(r"\s+", " ", statement).strip()
+
+def redact(parameters: Any, executemany: bool = False) -> Any:
+    """ログ用にパラメーターの値を型名に置き換える"""
+    if executemany:
+        return f"<{len(parameters)} rows>"
+    if isinstance(parameters, dict):
+        return {key: f"<{type(value).__name__}>" for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [f"<{type(value).__name__}>" for value in parameters]
+    return "<redacted>"
+
+def instrument_engine(engine):
+    """エンジンにイベントを登録する（非同期エンジンは sync_engine を渡す）"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        stats = current_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += elapsed
+            stats.statements[_normalize(statement)] += 1
+        if elapsed >= SLOW_QUERY_SECONDS:
+            metrics.db_slow_queries_total.inc()
+            logger.warning(
+                "Slow query (%.1f ms): %s parameters=%s",
+                elapsed * 1000,
+                _normalize(statement),
+                redact(parameters, executemany)
+            )
+
+    @event.listens_for(engine, "commit")
+    def _commit(conn):
+        stats = current_stats.get()
+        if stats is not None:
+            stats.commits += 1
+
+class QueryStatsMiddleware:
+    """リクエストごとにSQLの実行状況を集計するASGIミドルウェア"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats()
+        token = current_stats.set(stats)
+
+        async def send_wrapper(message):
+            if DEBUG_HEADERS and message["type"] == "http.response.start":
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-db-queries", str(stats.queries).encode()),
+                    (b"x-db-time-ms", f"{stats.db_time * 1000:.2f}".encode()),
+                    (b"x-db-commits", str(stats.commits).encode()),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_stats.reset(token)
+            method = scope["method"]
+            route = metrics.route_label(scope)
+            metrics.http_request_db_seconds.observe(stats.db_time, method=method, route=route)
+            metrics.http_request_db_queries.observe(stats.queries, method=method, route=route)
+            for statement, count in stats.repeated():
+                metrics.db_n_plus_one_total.inc(route=route)
+                logger.warning(
+                    "Possible N+1 in %s %s: executed %d times: %s",
+                    method, route, count, statement
+                )
@@ -0,0 +1,150 @@
+"""トークン数の計算
+
+エンコーダーは起動時に一度だけ読み込み、同じテキストの計算結果はLRUキャッシュで再利用する。
+長いテキストはスレッドプールで計算し、イベントループをブロックしない。
+
+TOKENIZER_VOCAB_DIR に語彙ファイル（tiktokenのキャッシュ形式）を置き、TOKENIZER_OFFLINE=1 を
+設定すると、起動時・計算時にBPEファイルをダウンロードしない。語彙ファイルは次のコマンドで作成できる:
+
+    python -m app.services.tokenizer download
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Optional
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# ここでは app.config を読み込まない（Dockerビルド時にAPIキーなしで語彙を取得するため）
+ENCODING_NAME = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+VOCAB_DIR = os.getenv(
+    "TOKENIZER_VOCAB_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "assets", "tiktoken")
+)
+OFFLINE = os.getenv("TOKENIZER_OFFLINE", "").lower() in ("1", "true", "yes")
+CACHE_SIZE = int(os.getenv("TOKENIZER_CACHE_SIZE", "4096"))
+CACHE_MAX_TEXT_LENGTH = 4096  # これより長いテキストはキャッシュしない
+THREAD_THRESHOLD = int(os.getenv("TOKENIZER_THREAD_THRESHOLD", "2000"))  # 文字数
+THREAD_WORKERS = int(os.getenv("TOKENIZER_THREAD_WORKERS", "2"))
+
+# tiktokenが語彙ファイルを取得するURL（キャッシュファイル名はこのURLのSHA1）
+VOCAB_URLS = {
+    "cl100k_base": "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken",
+    "p50k_base": "https://openaipublic.blob.core.windows.net/encodings/p50k_base.tiktoken",
+    "r50k_base": "https://openaipublic.blob.core.windows.net/encodings/r50k_base.tiktoken",
+}
+
+class TokenizerUnavailableError(RuntimeError):
+    """エンコーダーを読み込めない場合のエラー"""
+
+def _vocab_path(encoding_name: str) -> Optional[str]:
+    url = VOCAB_URLS.get(encoding_name)
+    if url is None:
+        return None
+    return os.path.join(VOCAB_DIR, hashlib.sha1(url.encode()).hexdigest())
+
+class TokenCounter:
+    def __init__(self, encoding_name: str = ENCODING_NAME):
+        self.encoding_name = encoding_name
+        self._encoding: Optional[tiktoken.Encoding] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._cached_count = lru_cache(maxsize=CACHE_SIZE)(self._count_uncached)
+
+    def load(self) -> tiktoken.Encoding:
+        """エンコーダーを読み込む（起動時に一度だけ呼ぶ）"""
+        if self._encoding is not None:
+            return self._encoding
+
+        vocab_path = _vocab_path(self.encoding_name)
+        if vocab_path and os.path.exists(vocab_path):
+            # 同梱の語彙ファイルを使用（tiktokenはキャッシュとして読み込み、ダウンロードしない）
+            os.environ["TIKTOKEN_CACHE_DIR"] = VOCAB_DIR
+        elif OFFLINE:
+            raise TokenizerUnavailableError(
+                f"語彙ファイルがありません: {vocab_path} "
+                "(python -m app.services.tokenizer download で作成してください)"
+            )
+
+        try:
+            self._encoding = tiktoken.get_encoding(self.encoding_name)
+        except Exception as e:
+            raise TokenizerUnavailableError(
+                f"エンコーダー {self.encoding_name} を読み込めません: {str(e)}"
+            ) from e
+
+        logger.info(f"Tokenizer loaded: {self.encoding_name}")
+        return self._encoding
+
+    def _count_uncached(self, text: str) -> int:
+        return len(self.load().encode(text, disallowed_special=()))
+
+    def count(self, text: str) -> int:
+        """テキストのトークン数を計算（同期）"""
+        if len(text) > CACHE_MAX_TEXT_LENGTH:
+            return self._count_uncached(text)
+        return self._cached_count(text)
+
+    async def count_async(self, text: str) -> int:
+        """長いテキストはスレッドプールで計算する"""
+        if len(text) < THREAD_THRESHOLD:
+            return self.count(text)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), self.count, text)
+
+    async def count_batch(self, texts: List[str]) -> List[int]:
+        """複数テキストのトークン数をまとめて計算"""
+        results = [0] * len(texts)
+        large = []
+        for i, text in enumerate(texts):
+            if len(text) < THREAD_THRESHOLD:
+                results[i] = self.count(text)
+            else:
+                large.append(i)
+
+        if large:
+            loop = asyncio.get_running_loop()
+            counts = await asyncio.gather(*[
+                loop.run_in_executor(self._get_executor(), self.count, texts[i])
+                for i in large
+            ])
+            for i, n in zip(large, counts):
+                results[i] = n
+        return results
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=THREAD_WORKERS,
+                thread_name_prefix="tokenizer"
+            )
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+token_counter = TokenCounter()
+
+def download_vocab(encoding_name: str = ENCODING_NAME) -> str:
+    """語彙ファイルを TOKENIZER_VOCAB_DIR に保存する"""
+    vocab_path = _vocab_path(encoding_name)
+    if vocab_path is None:
+        raise TokenizerUnavailableError(f"未対応のエンコーディングです: {encoding_name}")
+    os.makedirs(VOCAB_DIR, exist_ok=True)
+    os.environ["TIKTOKEN_CACHE_DIR"] = VOCAB_DIR
+    tiktoken.get_encoding(encoding_name)  # キャッシュとして VOCAB_DIR に書き込まれる
+    return vocab_path
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["download"]:
+        print(f"Saved vocabulary to {download_vocab(*sys.argv[2:3])}")
+    else:
+        print("usage: python -m app.services.tokenizer download [encoding_name]")
+        sys.exit(1)
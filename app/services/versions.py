@@ -0,0 +1,64 @@
+"""会話一覧・トークン残量・メッセージ履歴の条件付きGET（ETag / If-None-Match）
+
+書き込みのたびに、利用者ごと（会話一覧・トークン残量）と会話ごと（メッセージ履歴）の
+バージョンを同じトランザクションで1つ増やす。読み取りはまずバージョン（主キーで1行）を読んで
+ETagを作り、If-None-Matchと一致すれば一覧やメッセージを読まずに304を返す。
+
+バージョンはデータより先に同じトランザクションで読むため、古いETagに新しいデータが
+付くことはあっても（次回のリクエストで再取得されるだけ）、その逆は起きない。
+"""
+from typing import Optional
+import hashlib
+from fastapi import Request, Response
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..database import SyncVersion
+
+def user_scope(user_id: str) -> str:
+    return f"user:{user_id}"
+
+def conversation_scope(conversation_id: int) -> str:
+    return f"conversation:{conversation_id}"
+
+async def bump(db: AsyncSession, user_id: Optional[str] = None, conversation_id: Optional[int] = None):
+    """利用者・会話のバージョンを増やす（コミットは呼び出し側で行う）"""
+    scopes = []
+    if user_id is not None:
+        scopes.append(user_scope(user_id))
+    if conversation_id is not None:
+        scopes.append(conversation_scope(conversation_id))
+    if not scopes:
+        return
+    statement = insert(SyncVersion).values([{"scope": scope, "version": 1} for scope in scopes])
+    await db.execute(statement.on_conflict_do_update(
+        index_elements=[SyncVersion.scope],
+        set_={"version": SyncVersion.version + 1}
+    ))
+
+async def current(db: AsyncSession, scope: str) -> int:
+    version = await db.scalar(select(SyncVersion.version).where(SyncVersion.scope == scope))
+    return version or 0
+
+def etag(request: Request, version: int) -> str:
+    """バージョンとURL（パス・クエリ）から作るETag（ページや件数が違えば別のETagになる）"""
+    digest = hashlib.sha1(f"{request.url.path}?{request.url.query}".encode()).hexdigest()[:16]
+    return f'"{version}-{digest}"'
+
+def is_fresh(request: Request, tag: str) -> bool:
+    """If-None-Matchがtagと一致する（クライアントのキャッシュが最新）か"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # 弱いETag（W/）も同じものとして比較する
+    candidates = {candidate.strip().removeprefix("W/") for candidate in header.split(",")}
+    return tag in candidates
+
+def not_modified(tag: str) -> Response:
+    return Response(status_code=304, headers=cache_headers(tag))
+
+def cache_headers(tag: str) -> dict:
+    # キャッシュしてよいが、使う前に毎回ETagで確認させる
+    return {"ETag": tag, "Cache-Control": "no-cache"}
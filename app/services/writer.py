@@ -0,0 +1,166 @@
+"""書き込みのグループコミット
+
+リクエストごとにコミットする代わりに、書き込み処理をキューに入れ、バックグラウンドの
+ライターが最大 WRITER_MAX_DELAY_MS ミリ秒（または WRITER_MAX_BATCH 件）ごとに
+1つのトランザクションにまとめてコミットする。SQLiteのコミットごとのfsyncを減らすため。
+"""
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+import asyncio
+import logging
+import os
+from sqlalchemy import Integer, inspect
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH = int(os.getenv("WRITER_MAX_BATCH", "100"))
+MAX_DELAY = float(os.getenv("WRITER_MAX_DELAY_MS", "5")) / 1000
+
+Operation = Callable[[AsyncSession], Awaitable[Any]]
+
+class GroupCommitWriter:
+    def __init__(self, session_factory=AsyncSessionLocal, max_batch: int = MAX_BATCH, max_delay: float = MAX_DELAY):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """キューに残っている書き込みをコミットしてから停止"""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    def submit_nowait(self, op: Operation) -> asyncio.Future:
+        """書き込み処理をキューに入れる。Futureはコミット後にopの戻り値で完了する
+
+        opは渡されたセッションで書き込みを行う（コミットはしない）。失敗時に単独で
+        再実行されることがあるため、セッション外の状態を変更しないこと。
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((op, future))
+        return future
+
+    async def submit(self, op: Operation) -> Any:
+        return await self.submit_nowait(op)
+
+    def submit_detached(self, op: Operation) -> asyncio.Future:
+        """書き込み処理をキューに入れる（完了を待たず、失敗はログに記録する）"""
+        future = self.submit_nowait(op)
+        future.add_done_callback(_log_failure)
+        return future
+
+    async def add(self, *objects) -> List[Any]:
+        """ORMオブジェクトを追加し、コミット後に返す（IDが採番済み）"""
+        return await self.submit(_adder(objects))
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+
+            # 最初の書き込みから max_delay 以内に届いたものをまとめる
+            deadline = asyncio.get_running_loop().time() + self.max_delay
+            stopping = False
+            while len(batch) < self.max_batch:
+                timeout = deadline - asyncio.get_running_loop().time()
+                try:
+                    if timeout <= 0:
+                        item = self._queue.get_nowait()
+                    else:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+            if stopping:
+                return
+
+    async def _flush(self, batch: List[Tuple[Operation, asyncio.Future]]):
+        batch = [(op, future) for op, future in batch if not future.cancelled()]
+        if not batch:
+            return
+        try:
+            results = await self._commit(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                _set_exception(batch[0][1], e)
+                return
+            # まとめたトランザクションが失敗した場合は1件ずつ再実行し、失敗を該当の処理だけに限定する
+            logger.warning(f"Group commit of {len(batch)} writes failed, retrying individually: {str(e)}")
+            for entry in batch:
+                try:
+                    _set_result(entry[1], (await self._commit([entry]))[0])
+                except Exception as single_error:
+                    _set_exception(entry[1], single_error)
+            return
+        for (op, future), result in zip(batch, results):
+            _set_result(future, result)
+
+    async def _commit(self, batch: List[Tuple[Operation, asyncio.Future]]) -> List[Any]:
+        async with self.session_factory() as session:
+            try:
+                results = []
+                for op, future in batch:
+                    results.append(await op(session))
+                    await session.flush()
+                await session.commit()
+                return results
+            except BaseException:
+                await session.rollback()
+                raise
+
+def _adder(objects) -> Operation:
+    # 採番される主キー（追加時に未設定のもの）。失敗したトランザクションで採番された値は
+    # ロールバック後もオブジェクトに残り、再実行でその値のまま挿入されてしまうため、毎回戻す
+    generated = [
+        (obj, key)
+        for obj in objects
+        for key in _autoincrement_keys(obj)
+        if getattr(obj, key) is None
+    ]
+
+    async def op(session: AsyncSession):
+        for obj, key in generated:
+            setattr(obj, key, None)
+        session.add_all(objects)
+        return list(objects)
+    return op
+
+def _autoincrement_keys(obj) -> List[str]:
+    mapper = inspect(obj).mapper
+    return [
+        mapper.get_property_by_column(column).key
+        for column in mapper.primary_key
+        if column.autoincrement in (True, "auto") and isinstance(column.type, Integer)
+    ]
+
+def _set_result(future: asyncio.Future, result):
+    if not future.done():
+        future.set_result(result)
+
+def _set_exception(future: asyncio.Future, error: Exception):
+    if not future.done():
+        future.set_exception(error)
+
+def _log_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Background write failed: {str(future.exception())}")
+
+writer = GroupCommitWriter()
@@ -0,0 +1,67 @@
+"""SQLiteの接続設定（すべてのエンジンはここから作成する）
+
+- DBファイルは DATABASE_PATH（既定: ./sql_app.db）の1つだけ
+- WALモードで、読み取りが書き込みを待たない
+- 読み取り専用の接続プールを別に持つ（PRAGMA query_only）
+"""
+import os
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+DATABASE_PATH = os.getenv("DATABASE_PATH", "./sql_app.db")
+
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
+ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{DATABASE_PATH}"
+
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",  # WALではコミットごとのfsyncが不要
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "temp_store": "MEMORY",
+}
+
+WRITE_POOL_SIZE = int(os.getenv("SQLITE_WRITE_POOL_SIZE", "5"))
+READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "10"))
+
+def _install_pragmas(sync_engine, read_only: bool = False):
+    @event.listens_for(sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in PRAGMAS.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            if read_only:
+                cursor.execute("PRAGMA query_only=ON")
+        finally:
+            cursor.close()
+
+def create_sync_engine():
+    """同期エンジン（起動時のテーブル作成・マイグレーション用）"""
+    engine = create_engine(
+        SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    )
+    _install_pragmas(engine)
+    return engine
+
+def create_async_write_engine():
+    engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        poolclass=AsyncAdaptedQueuePool,  # aiosqliteの既定（NullPool）では接続を毎回開き直す
+        pool_size=WRITE_POOL_SIZE,
+        max_overflow=WRITE_POOL_SIZE
+    )
+    _install_pragmas(engine.sync_engine)
+    return engine
+
+def create_async_read_engine():
+    """読み取り専用の接続プール（WALのため書き込み中も待たずに読める）"""
+    engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        poolclass=AsyncAdaptedQueuePool,  # aiosqliteの既定（NullPool）では接続を毎回開き直す
+        pool_size=READ_POOL_SIZE,
+        max_overflow=READ_POOL_SIZE
+    )
+    _install_pragmas(engine.sync_engine, read_only=True)
+    return engine
@@ -0,0 +1,91 @@
+"""負荷試験用のDify APIのダミーサーバー
+
+    python -m bench.fake_dify --port 9000 --latency 300 --error-rate 0.01
+
+アプリ側は DIFY_BASE_URL=http://127.0.0.1:9000/v1 を設定して起動する。
+blocking / streaming の両方の response_mode に対応する。
+"""
+import argparse
+import asyncio
+import json
+import random
+import uuid
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+class FakeDifySettings:
+    latency = 0.3  # 最初の応答までの秒数
+    jitter = 0.1  # latencyに加えるランダムな秒数（0〜jitter）
+    error_rate = 0.0  # 503を返す割合
+    chunks = 20  # streamingで送る断片の数
+    chunk_delay = 0.02  # 断片の間隔（秒）
+    answer = "これはダミーの応答です。"
+
+settings = FakeDifySettings()
+app = FastAPI()
+
+@app.post("/v1/chat-messages")
+async def chat_messages(request: Request):
+    body = await request.json()
+    await asyncio.sleep(settings.latency + random.uniform(0, settings.jitter))
+
+    if random.random() < settings.error_rate:
+        return JSONResponse(status_code=503, content={"message": "fake upstream error"})
+
+    conversation_id = body.get("conversation_id") or str(uuid.uuid4())
+    message_id = str(uuid.uuid4())
+    answer = f"{settings.answer} ({body.get('query', '')[:20]})"
+    usage = {"total_tokens": len(answer)}
+
+    if body.get("response_mode") != "streaming":
+        return {
+            "event": "message",
+            "message_id": message_id,
+            "conversation_id": conversation_id,
+            "answer": answer,
+            "metadata": {"usage": usage},
+        }
+
+    async def events():
+        size = max(1, len(answer) // max(1, settings.chunks))
+        for i in range(0, len(answer), size):
+            event = {
+                "event": "message",
+                "message_id": message_id,
+                "conversation_id": conversation_id,
+                "answer": answer[i:i + size],
+            }
+            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+            await asyncio.sleep(settings.chunk_delay)
+        end = {
+            "event": "message_end",
+            "message_id": message_id,
+            "conversation_id": conversation_id,
+            "metadata": {"usage": usage},
+        }
+        yield f"data: {json.dumps(end)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+def main():
+    parser = argparse.ArgumentParser(description="Dify APIのダミーサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=300, help="最初の応答までのミリ秒")
+    parser.add_argument("--jitter", type=float, default=100, help="latencyに加えるランダムなミリ秒の上限")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="503を返す割合（0〜1）")
+    parser.add_argument("--chunks", type=int, default=20, help="streamingで送る断片の数")
+    parser.add_argument("--chunk-delay", type=float, default=20, help="断片の間隔（ミリ秒）")
+    args = parser.parse_args()
+
+    settings.latency = args.latency / 1000
+    settings.jitter = args.jitter / 1000
+    settings.error_rate = args.error_rate
+    settings.chunks = args.chunks
+    settings.chunk_delay = args.chunk_delay / 1000
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""サーバー経路の負荷試験
+
+ダミーのDifyサーバーとアプリを起動してから実行する:
+
+    python -m bench.fake_dify --port 9000 &
+    DIFY_BASE_URL=http://127.0.0.1:9000/v1 uvicorn app.main:app --port 8000 &
+    python -m bench.loadgen --url http://127.0.0.1:8000 --concurrency 50 --duration 30
+
+シナリオごとに件数・エラー数・スループット・p50/p95/p99（ミリ秒）を表示する。
+--json を指定すると結果をJSONで出力する（デプロイ前の比較用）。
+WebSocketのシナリオには websockets パッケージが必要（なければ省略する）。
+"""
+from typing import Awaitable, Callable, Dict, List, Optional
+import argparse
+import asyncio
+import json
+import math
+import time
+import uuid
+import httpx
+
+try:
+    import websockets
+except ImportError:  # WebSocketのシナリオのみ省略する
+    websockets = None
+
+SCENARIOS = ("chat", "proxy_blocking", "proxy_streaming", "history", "ws", "ws_user")
+
+class Recorder:
+    """シナリオごとのレイテンシとエラーを記録する"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def record(self, name: str, seconds: float, ok: bool = True):
+        if ok:
+            self.latencies.setdefault(name, []).append(seconds)
+        else:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    async def measure(self, name: str, call: Callable[[], Awaitable[bool]]):
+        start = time.perf_counter()
+        try:
+            ok = await call()
+        except Exception:
+            ok = False
+        self.record(name, time.perf_counter() - start, ok)
+
+    def summary(self, elapsed: float) -> Dict[str, dict]:
+        result = {}
+        for name in sorted(set(self.latencies) | set(self.errors)):
+            samples = sorted(self.latencies.get(name, []))
+            result[name] = {
+                "count": len(samples),
+                "errors": self.errors.get(name, 0),
+                "rps": len(samples) / elapsed if elapsed else 0.0,
+                "p50_ms": percentile(samples, 50) * 1000,
+                "p95_ms": percentile(samples, 95) * 1000,
+                "p99_ms": percentile(samples, 99) * 1000,
+            }
+        return result
+
+def percentile(samples: List[float], p: float) -> float:
+    """ソート済みのサンプルのpパーセンタイル（nearest-rank）"""
+    if not samples:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(samples)))
+    return samples[rank - 1]
+
+class Worker:
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder, args, index: int):
+        self.client = client
+        self.recorder = recorder
+        self.args = args
+        self.user_id = f"bench-{index}"
+        self.counter = 0
+
+    def next_message(self) -> str:
+        # --unique の場合は質問を毎回変えて、応答キャッシュとsingle-flightを避ける
+        self.counter += 1
+        if self.args.unique:
+            return f"{self.args.message} {self.user_id}-{self.counter}-{uuid.uuid4().hex[:8]}"
+        return self.args.message
+
+    async def chat(self) -> bool:
+        """/chat でトークンを確保し、/chat/response で精算する"""
+        response = await self.client.post(
+            "/chat",
+            json={"user_id": self.user_id, "message": self.next_message()}
+        )
+        if response.status_code == 403:
+            # トークン不足は負荷試験の対象外なのでリセットして続ける
+            await self.client.post(f"/tokens/reset/{self.user_id}")
+            return True
+        if response.status_code != 200:
+            return False
+        reservation_id = response.json().get("reservation_id")
+        response = await self.client.post(
+            "/chat/response",
+            json={
+                "user_id": self.user_id,
+                "response": "ベンチマークの応答です。",
+                "reservation_id": reservation_id
+            }
+        )
+        return response.status_code == 200
+
+    async def proxy_blocking(self) -> bool:
+        response = await self.client.post(
+            "/support/proxy/dify",
+            json={"message": self.next_message(), "stream": False}
+        )
+        return response.status_code == 200
+
+    async def proxy_streaming(self) -> bool:
+        """最初のイベントまでの時間を proxy_streaming_ttfb として別に記録する"""
+        start = time.perf_counter()
+        first = True
+        async with self.client.stream(
+            "POST",
+            "/support/proxy/dify",
+            json={"message": self.next_message(), "stream": True}
+        ) as response:
+            if response.status_code != 200:
+                return False
+            async for line in response.aiter_lines():
+                if first and line.startswith("data:"):
+                    self.recorder.record("proxy_streaming_ttfb", time.perf_counter() - start)
+                    first = False
+                # プロキシはエラーも `data: {"event": "error", ...}` として送る
+                if line.startswith("data:") and _is_error_event(line[len("data:"):]):
+                    return False
+        return not first
+
+    async def history(self) -> bool:
+        response = await self.client.get(f"/conversations/{self.user_id}")
+        if response.status_code != 200:
+            return False
+        items = response.json().get("items", [])
+        if items:
+            response = await self.client.get(f"/conversations/{items[0]['id']}/messages")
+            return response.status_code == 200
+        return True
+
+    async def ws(self) -> bool:
+        """/ws で1往復する（接続ごとに計測）"""
+        async with websockets.connect(self.ws_url("/ws")) as socket:
+            await self.recv(socket)  # support_select
+            await socket.send(json.dumps({"type": "message", "text": self.next_message()}))
+            return await self.wait_for_end(socket)
+
+    async def ws_user(self) -> bool:
+        async with websockets.connect(self.ws_url(f"/ws/{self.user_id}")) as socket:
+            await socket.send(json.dumps({"message": self.next_message()}))
+            return await self.wait_for_end(socket)
+
+    async def wait_for_end(self, socket) -> bool:
+        """応答のフレーム（start / delta / end）を読み、endならTrue、errorならFalse"""
+        while True:
+            frame = await self.recv(socket)
+            if frame.get("type") == "end":
+                return True
+            if frame.get("type") == "error":
+                return False
+
+    async def recv(self, socket) -> dict:
+        # 応答が来ない場合も --timeout で打ち切り、エラーとして数える
+        return json.loads(await asyncio.wait_for(socket.recv(), self.args.timeout))
+
+    def ws_url(self, path: str) -> str:
+        return self.args.url.replace("http", "ws", 1).rstrip("/") + path
+
+    async def run(self, scenarios: List[str], deadline: float):
+        i = 0
+        while time.monotonic() < deadline:
+            name = scenarios[i % len(scenarios)]
+            i += 1
+            await self.recorder.measure(name, getattr(self, name))
+
+def _is_error_event(data: str) -> bool:
+    try:
+        payload = json.loads(data)
+    except ValueError:
+        return False
+    return isinstance(payload, dict) and payload.get("event") == "error"
+
+async def run(args) -> Dict[str, dict]:
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"不明なシナリオ: {', '.join(unknown)}")
+    if websockets is None and any(s in ("ws", "ws_user") for s in scenarios):
+        print("websockets がインストールされていないため、WebSocketのシナリオを省略します")
+        scenarios = [s for s in scenarios if s not in ("ws", "ws_user")]
+    if not scenarios:
+        raise SystemExit("実行できるシナリオがありません")
+
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout) as client:
+        workers = [Worker(client, recorder, args, i) for i in range(args.concurrency)]
+        start = time.monotonic()
+        deadline = start + args.duration
+        # ワーカーごとに開始シナリオをずらして、同時に同じ経路だけを叩かないようにする
+        await asyncio.gather(*(
+            worker.run(scenarios[i % len(scenarios):] + scenarios[:i % len(scenarios)], deadline)
+            for i, worker in enumerate(workers)
+        ))
+        elapsed = time.monotonic() - start
+    return recorder.summary(elapsed)
+
+def print_table(summary: Dict[str, dict]):
+    header = f"{'scenario':<22}{'count':>8}{'errors':>8}{'rps':>10}{'p50':>10}{'p95':>10}{'p99':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, row in summary.items():
+        print(
+            f"{name:<22}{row['count']:>8}{row['errors']:>8}{row['rps']:>10.1f}"
+            f"{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}"
+        )
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="サーバー経路の負荷試験")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=30, help="秒数")
+    parser.add_argument("--timeout", type=float, default=30, help="1リクエストのタイムアウト秒数")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="カンマ区切り: " + ",".join(SCENARIOS))
+    parser.add_argument("--message", default="ベンチマークの質問です")
+    parser.add_argument("--unique", action="store_true", help="質問を毎回変えてキャッシュを無効にする")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    args = parser.parse_args(argv)
+
+    summary = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    else:
+        print_table(summary)
+
+if __name__ == "__main__":
+    main()
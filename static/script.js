@@ -260,14 +260,27 @@ document.addEventListener('click', function(event) {
     }
 });
 
-// 会話リストを読み込む関数の修正
-async function loadConversations() {
-    try {
-        const response = await fetch(`${BASE_URL}/conversations/test_user`);
+// 会話リストをすべて取得（ページ単位で返されるため、next_cursorがなくなるまで読む）
+async function fetchAllConversations() {
+    const conversations = [];
+    let cursor = null;
+    do {
+        const query = cursor ? `?after=${encodeURIComponent(cursor)}` : '';
+        const response = await fetch(`${BASE_URL}/conversations/test_user${query}`);
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
-        const conversations = await response.json();
+        const page = await response.json();
+        conversations.push(...page.items);
+        cursor = page.next_cursor;
+    } while (cursor);
+    return conversations;
+}
+
+// 会話リストを読み込む関数の修正
+async function loadConversations() {
+    try {
+        const conversations = await fetchAllConversations();
         
         const list = document.getElementById('conversation-list');
         list.innerHTML = '';
@@ -0,0 +1,62 @@
+import asyncio
+import pytest
+from app.services.dify.singleflight import SingleFlight
+
+def test_do_late_joiner_after_last_waiter_cancelled():
+    """最後の待機者がキャンセルされた直後に来た呼び出しは、新しい呼び出しとして実行される"""
+    async def main():
+        flight = SingleFlight()
+        calls = 0
+
+        async def fn():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return calls
+
+        leader = asyncio.ensure_future(flight.do("key", fn))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        # 中止した呼び出しのタスクが終わる前に合流する
+        return await flight.do("key", fn), calls
+
+    result, calls = asyncio.run(main())
+    assert result == 2
+    assert calls == 2
+
+def test_do_stream_late_joiner_after_last_receiver_left():
+    async def main():
+        flight = SingleFlight()
+        calls = 0
+
+        async def fn():
+            nonlocal calls
+            calls += 1
+            for i in range(3):
+                await asyncio.sleep(0.01)
+                yield (calls, i)
+
+        stream = flight.do_stream("key", fn)
+        assert await stream.__anext__() == (1, 0)
+        await stream.aclose()
+        return [event async for event in flight.do_stream("key", fn)]
+
+    assert asyncio.run(main()) == [(2, 0), (2, 1), (2, 2)]
+
+def test_do_shares_result_between_waiters():
+    async def main():
+        flight = SingleFlight()
+        calls = 0
+
+        async def fn():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        results = await asyncio.gather(flight.do("key", fn), flight.do("key", fn))
+        return results, calls, flight.shared
+
+    assert asyncio.run(main()) == (["answer", "answer"], 1, 1)